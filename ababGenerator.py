@@ -2,6 +2,7 @@ import config
 import os
 import markovify
 import pronouncing
+import modelCache
 
 # Make it object oriented!!!
 
@@ -17,11 +18,9 @@ class ABAB_poem:
 
     def generate_poem(self):
 
-        all_text = "";
-        for i in os.listdir(self.config.markovify_input_dir):
-            with open(self.config.markovify_input_dir + i) as f:
-                all_text += f.read()
-        text_model = markovify.Text(all_text)
+        paths = [self.config.markovify_input_dir + i
+                 for i in os.listdir(self.config.markovify_input_dir)]
+        text_model = modelCache.loadModel(markovify.Text, paths)
 
         poemNotDone = 1
 
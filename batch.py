@@ -0,0 +1,136 @@
+import argparse
+import contextlib
+import json
+import sys
+import time
+import config
+import instrument
+import logSetup
+import new_r_sonet_gen_parallel as crown
+import seeding
+
+# Batch generation of poems.
+#
+# A batch is a list of (pattern, count) specs. The models are loaded once in
+# the parent and the poems are spread over the generation pool from
+# new_r_sonet_gen_parallel, whose workers inherit the models. Poems are
+# scheduled longest pattern first and handed out in chunks, so workers stay
+# busy and the tail of the batch is made of the quick ones. Results come back
+# in completion order and are written as JSON Lines, one poem per line, as
+# soon as they arrive. A poem that fails, e.g. by running out of its
+# config.job_max_attempts sentence attempts, is reported with an error
+# instead of stopping the batch. The workers' instrument counters are
+# collected with the results, so --stats reports on the whole batch.
+
+DEFAULT_FILE = crown.DEFAULT_FILE
+DEFAULT_CHUNKSIZE = 4
+
+def parseSpec(spec):
+    """Parse 'PATTERN[:COUNT]', e.g. 'ABAB6767:100', into (pattern, count)"""
+    pattern, _, count = spec.partition(':')
+    count = int(count) if count else 1
+    if not crown.valid_pattern(pattern) or count < 0:
+        raise ValueError('Invalid batch spec: ' + spec)
+    return pattern, count
+
+def lineCount(pattern):
+    return len(''.join(c for c in pattern if not c.isdigit()))
+
+def batchTasks(specs, seed=None):
+    """Task descriptors (index, pattern, seed) for all poems in specs, longest
+    patterns first. Indices number the poems in spec order, and each poem's
+    seed is derived from seed and its index."""
+    tasks = []
+    for pattern, count in specs:
+        for _ in range(count):
+            index = len(tasks)
+            tasks.append((index, pattern, seeding.deriveSeed(seed, 'batch', index)))
+    tasks.sort(key=lambda task: lineCount(task[1]), reverse=True)
+    return tasks
+
+def _batch_task(task):
+    """Generate one poem of a batch, keeping its progress output off stdout"""
+    index, pattern, seed = task
+    start = time.monotonic()
+    result = {'index': index, 'pattern': pattern, 'seed': seed}
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            with crown.attempt_limit(config.Config().job_max_attempts):
+                result['poem'] = crown._sonnet_task((pattern, None, None, seed)).poem
+        except Exception as e:
+            result['error'] = repr(e)
+    result['seconds'] = round(time.monotonic() - start, 3)
+    result['stats'] = crown._task_stats()
+    return result
+
+def generateBatch(specs, fFile=DEFAULT_FILE, processes=None, chunksize=DEFAULT_CHUNKSIZE,
+                  seed=None):
+    """Yield a result dict for every poem in specs, in completion order.
+    processes=0 generates in this process without a pool. Seeded batches
+    give the same poems for any number of processes. Instrument stats of
+    the poems are merged into this process's."""
+    if seed is None:
+        seed = config.Config().seed
+    with contextlib.redirect_stdout(sys.stderr):
+        crown._init_worker(fFile)
+    tasks = batchTasks(specs, seed)
+
+    if processes == 0:
+        for task in tasks:
+            result = _batch_task(task)
+            instrument.merge(result.pop('stats'))
+            yield result
+        return
+
+    pool = crown.get_pool(fFile, processes, config.Config().pool_max_tasks_per_child)
+    try:
+        for result in pool.imap_unordered(_batch_task, tasks, chunksize):
+            instrument.merge(result.pop('stats'))
+            yield result
+    finally:
+        crown.close_pool()
+
+def writeJsonLines(results, out):
+    """Write results to out as JSON Lines, returning the number of failures"""
+    failures = 0
+    for result in results:
+        failures += 'error' in result
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate poems in bulk as JSON Lines.')
+    parser.add_argument('specs', nargs='+', metavar='PATTERN[:COUNT]',
+                        help='rhyme and syllable pattern with a poem count, e.g. ABAB6767:100')
+    parser.add_argument('-f', '--file', default=DEFAULT_FILE, help='corpus file')
+    parser.add_argument('-o', '--output', help='output file, stdout by default')
+    parser.add_argument('-p', '--processes', type=int, default=config.Config().pool_processes,
+                        help='worker processes, 0 for none, one per core by default')
+    parser.add_argument('-c', '--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help='poems handed to a worker at a time')
+    parser.add_argument('-s', '--seed', type=int, help='seed for reproducible batches')
+    parser.add_argument('--stats', help='write counters and timers of the batch to this JSON file')
+    parser.add_argument('--profile', help='profile this process with cProfile, dumping the stats here')
+    parser.add_argument('--log-level', help='DEBUG, INFO, WARNING, ... (config.log_level by default)')
+    args = parser.parse_args(argv)
+    logSetup.configureLogging(args.log_level)
+
+    try:
+        specs = [parseSpec(spec) for spec in args.specs]
+    except ValueError as e:
+        parser.error(str(e))
+
+    results = generateBatch(specs, args.file, args.processes, args.chunksize, args.seed)
+    with instrument.profiled(args.profile):
+        if args.output:
+            with open(args.output, 'a', encoding='utf-8') as out:
+                failures = writeJsonLines(results, out)
+        else:
+            failures = writeJsonLines(results, sys.stdout)
+    if args.stats:
+        instrument.writeReport(args.stats, specs=args.specs, failures=failures)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+import argparse
+import contextlib
+import datetime
+import functools
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import config
+import generateRhymes as gr
+import groupSearch
+import instrument
+import markoviRhyme
+import modelCache
+import new_r_sonet_gen_parallel as crown
+import rhyme
+import rhymeDegree
+import seeding
+import syllableCount
+from syllableWalk import SyllableWalk
+
+# Benchmark of the generation pipeline.
+#
+# Runs a fixed, seeded workload in this process: model loading (and building
+# with --cold), rhyme lookups, rhyme degrees, syllable counts, then poems and
+# crowns. While it runs, the pipeline's stage functions are wrapped to record
+# the latency of every call and how many calls came back empty, i.e. rejected
+# lines and failed walks or searches. Stage timings are inclusive, a group's
+# time contains the lines built for it. The report gives throughput, latency
+# percentiles per stage, rejection counts, the pipeline's own instrument
+# counters and peak RSS, and is appended to
+# benchmarks/results.jsonl with the current commit so runs can be compared
+# across commits. Generation runs serially so the stage timings are complete.
+#
+# Startup is timed in fresh interpreters, as a CLI invocation or a spawned
+# worker pays it: importing the generator and, on top of that, loading the
+# models the way a worker does (_init_worker, shared models if configured).
+# The medians are checked against STARTUP_BUDGET.
+
+DEFAULT_CORPUS = crown.DEFAULT_FILE
+DEFAULT_PATTERNS = ['ABCB7676', 'ABABCDCDEFEFGG77777777777777']
+DEFAULT_CROWN = 'ABCB7676'
+DEFAULT_POEMS = 10
+DEFAULT_CROWNS = 1
+DEFAULT_SEED = 1234
+DEFAULT_SAMPLE = 2000
+DEFAULT_OUTPUT = 'benchmarks/results.jsonl'
+DEFAULT_STARTUP_RUNS = 3
+
+# Cold start budget in seconds: interpreter and imports, then worker models
+STARTUP_BUDGET = {'import_s': 0.3, 'models_s': 0.5}
+
+STARTUP_CODE = '''
+import json, os, sys, time
+start = time.perf_counter()
+import new_r_sonet_gen_parallel as crown
+imported = time.perf_counter()
+crown._init_worker(sys.argv[1])
+print(json.dumps({'import_s': imported - start, 'models_s': time.perf_counter() - imported}))
+sys.stdout.flush()
+# Tearing the models down is not startup
+os._exit(0)
+'''
+
+# Stage name -> (owner, attribute) of the functions wrapped while running
+STAGES = {
+    'group_reverse': (crown.Poem, '_build_group_reverse'),
+    'group_forward': (crown.Poem, '_build_group'),
+    'anchor_line': (crown.Poem, '_new_anchor_sentence'),
+    'sentence': (crown.Poem, '_new_sentence'),
+    'rhyming_sentence': (crown.Poem, '_new_rhyming_sentence'),
+    'group_search': (groupSearch, 'searchGroup'),
+    'syllable_walk': (SyllableWalk, 'walk_syllables'),
+    'syllable_count': (syllableCount.SyllableCounter, 'countLine'),
+    'rhyme_pair': (crown, 'is_rhyme_pair'),
+    'rhyme_degree': (rhymeDegree, 'rhyme_degree'),
+}
+
+class Recorder:
+    """Latencies and empty results of calls, per stage"""
+
+    def __init__(self):
+        self.times = {}
+        self.empty = {}
+
+    def add(self, stage, seconds, result=True):
+        self.times.setdefault(stage, []).append(seconds)
+        if result is None:
+            self.empty[stage] = self.empty.get(stage, 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.add(name, time.perf_counter() - start)
+
+    def wrap(self, stage, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            self.add(stage, time.perf_counter() - start, result)
+            return result
+        return timed
+
+    @contextlib.contextmanager
+    def patched(self, stages=STAGES):
+        """Wrap the stage functions for the duration of the block"""
+        originals = [(owner, attr, owner.__dict__[attr]) for owner, attr in stages.values()]
+        try:
+            for (name, (owner, attr)), (_, _, func) in zip(stages.items(), originals):
+                setattr(owner, attr, self.wrap(name, func))
+            yield self
+        finally:
+            for owner, attr, func in originals:
+                setattr(owner, attr, func)
+
+    def report(self):
+        return {stage: dict(summarise(times), empty=self.empty.get(stage, 0))
+                for stage, times in sorted(self.times.items())}
+
+def percentile(ordered, q):
+    """Nearest rank percentile of a sorted list"""
+    return ordered[min(len(ordered) - 1, int(q / 100.0 * len(ordered)))]
+
+def summarise(times):
+    """Count, total and latency percentiles in milliseconds"""
+    ordered = sorted(times)
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {'count': len(ordered), 'total_s': round(sum(ordered), 3),
+            'mean_ms': ms(sum(ordered) / len(ordered)),
+            'p50_ms': ms(percentile(ordered, 50)), 'p90_ms': ms(percentile(ordered, 90)),
+            'p99_ms': ms(percentile(ordered, 99)), 'max_ms': ms(ordered[-1])}
+
+def peakRss():
+    """Peak resident set size in KiB of this process and of its children"""
+    units = 1 if sys.platform.startswith('linux') else 1024  # macOS reports bytes
+    return {'self_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // units,
+            'children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // units}
+
+def gitCommit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+def benchModels(rec, corpus, cold):
+    """Load the models through the cache, and with cold also build them"""
+    if cold:
+        paths = gr.corpusFiles(corpus)
+        with rec.stage('model_build'):
+            forward = markoviRhyme.forwardText(modelCache.readCorpus(paths), state_size=2)
+            markoviRhyme.rhymeText(None, parsed_sentences=gr.reverseSentences(
+                forward.parsed_sentences))
+    with rec.stage('model_load'):
+        crown._init_worker(corpus)
+    return crown._worker_models['forw'], crown._worker_models['rev']
+
+def benchLookups(rec, forw_model, sample):
+    """Rhyme lookups, rhyme degrees and syllable counts on vocabulary words"""
+    words = sorted(w.strip('.,;:!?"\'()').lower()
+                   for w in syllableCount.chainVocabulary(forw_model.chain))
+    words = [w for w in words if w in rhyme.pronunciationDict()]
+    words = random.sample(words, min(sample, len(words)))
+
+    for word in words:
+        with rec.stage('rhyme_lookup'):
+            rhyme.generateRhymes(word, 2)
+
+    rhymeDegree.pair_degree.cache_clear()
+    rhymeDegree.rhyme_tail.cache_clear()
+    for target, test in zip(words, words[1:] + words[:1]):
+        with rec.stage('rhyme_degree_uncached'):
+            rhymeDegree.rhyme_degree(target, test)
+
+    counter = syllableCount.SyllableCounter()
+    for i in range(0, len(words) - 6, 7):
+        with rec.stage('syllable_count_uncached'):
+            counter.countLine(' '.join(words[i:i+7]))
+
+def benchPoems(rec, forw_model, rev_model, patterns, poems, seed):
+    """Generate `poems` poems per pattern, returning lines and poems made"""
+    lines = made = 0
+    for pattern in patterns:
+        for i in range(poems):
+            with rec.stage('poem'), rec.stage('poem ' + pattern):
+                poem = crown.Poem(pattern, forw_model, rev_model,
+                                  seed=seeding.deriveSeed(seed, 'poem', pattern, i))
+            lines += len(poem.poem.split('\n'))
+            made += 1
+    return lines, made
+
+def benchCrowns(rec, corpus, forw_model, rev_model, pattern, crowns, seed):
+    for i in range(crowns):
+        with rec.stage('crown'):
+            sonnet_crown = crown.Sonnet_crown(pattern, None, forw_model, rev_model, corpus,
+                                              seed=seeding.deriveSeed(seed, 'crown', i))
+            sonnet_crown.generate_full()
+            sonnet_crown.close()
+
+def benchStartup(corpus, runs):
+    """Median startup times of runs fresh interpreters; import_s includes
+    starting the interpreter"""
+    times = {'import_s': [], 'models_s': []}
+    here = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', STARTUP_CODE, corpus], cwd=here,
+                             stdout=subprocess.PIPE, check=True).stdout
+        total = time.perf_counter() - start
+        run = json.loads(out.decode().splitlines()[-1])
+        times['import_s'].append(total - run['models_s'])
+        times['models_s'].append(run['models_s'])
+    return {name: round(sorted(values)[len(values) // 2], 3) for name, values in times.items()}
+
+def runBenchmark(corpus=DEFAULT_CORPUS, patterns=DEFAULT_PATTERNS, poems=DEFAULT_POEMS,
+                 crown_pattern=DEFAULT_CROWN, crowns=DEFAULT_CROWNS, seed=DEFAULT_SEED,
+                 sample=DEFAULT_SAMPLE, cold=False, startup=DEFAULT_STARTUP_RUNS):
+    """Run the benchmark and return its result record"""
+    seeding.seedRandom(seed)
+    instrument.reset()
+    rec = Recorder()
+    start = time.perf_counter()
+    # Generation progress output is not part of the benchmark
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        forw_model, rev_model = benchModels(rec, corpus, cold)
+        benchLookups(rec, forw_model, sample)
+        with rec.patched():
+            poem_start = time.perf_counter()
+            lines, made = benchPoems(rec, forw_model, rev_model, patterns, poems, seed)
+            poem_time = time.perf_counter() - poem_start
+            crown_start = time.perf_counter()
+            benchCrowns(rec, corpus, forw_model, rev_model, crown_pattern, crowns, seed)
+            crown_time = time.perf_counter() - crown_start
+    startup_times = benchStartup(corpus, startup) if startup else None
+
+    settings = {'corpus': corpus, 'patterns': patterns, 'poems': poems,
+                'crown': crown_pattern, 'crowns': crowns, 'seed': seed,
+                'sample': sample, 'cold': cold}
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'settings': settings,
+        'config': vars(config.Config()),
+        'throughput': {
+            'lines_per_s': round(lines / poem_time, 2) if poem_time else None,
+            'poems_per_s': round(made / poem_time, 3) if poem_time else None,
+            'crowns_per_min': round(crowns * 60 / crown_time, 3) if crowns else None,
+        },
+        'stages': rec.report(),
+        'startup': startup_times,
+        'instrument': instrument.report(),
+        'rss': peakRss(),
+        'wall_s': round(time.perf_counter() - start, 3),
+    }
+
+def previousResult(path, settings):
+    """Latest stored result with the same settings, or None"""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('settings') == settings:
+                previous = record
+    return previous
+
+def printResult(result, previous=None):
+    print('Commit %s, %s' % (result['commit'], result['settings']['corpus']))
+    for name, value in result['throughput'].items():
+        change = ''
+        if previous and value and previous['throughput'].get(name):
+            change = ' (%+.1f%% vs %s)' % (100.0 * (value / previous['throughput'][name] - 1),
+                                           previous['commit'])
+        print('  %-16s %s%s' % (name, value, change))
+    width = max(len(stage) for stage in result['stages'])
+    print('  %-*s %7s %10s %10s %10s %10s %7s' % (
+        width, 'stage', 'count', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'empty'))
+    for stage, s in result['stages'].items():
+        print('  %-*s %7d %10.3f %10.3f %10.3f %10.3f %7d' % (
+            width, stage, s['count'], s['mean_ms'], s['p50_ms'], s['p90_ms'], s['p99_ms'],
+            s['empty']))
+    for name, seconds in (result.get('startup') or {}).items():
+        budget = STARTUP_BUDGET.get(name)
+        over = ' OVER BUDGET' if budget and seconds > budget else ''
+        print('  startup %-9s %.3f s (budget %s s)%s' % (name[:-2], seconds, budget, over))
+    counters = result.get('instrument', {}).get('counters', {})
+    if counters:
+        print('  ' + ', '.join('%s %d' % item for item in counters.items()))
+    print('  peak RSS %d KiB' % result['rss']['self_kb'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the poem generation pipeline.')
+    parser.add_argument('-f', '--corpus', default=DEFAULT_CORPUS,
+                        help='corpus file or directory, e.g. austenBooks/')
+    parser.add_argument('-p', '--pattern', action='append', dest='patterns',
+                        help='poem pattern, repeatable (default %s)' % ' '.join(DEFAULT_PATTERNS))
+    parser.add_argument('-n', '--poems', type=int, default=DEFAULT_POEMS, help='poems per pattern')
+    parser.add_argument('--crown', default=DEFAULT_CROWN, help='crown pattern')
+    parser.add_argument('-c', '--crowns', type=int, default=DEFAULT_CROWNS, help='crowns to generate')
+    parser.add_argument('-s', '--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--sample', type=int, default=DEFAULT_SAMPLE,
+                        help='words used for the lookup stages')
+    parser.add_argument('--cold', action='store_true', help='also time building the models')
+    parser.add_argument('--startup', type=int, default=DEFAULT_STARTUP_RUNS,
+                        help='fresh interpreters to time startup in, 0 to skip')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT, help='results file to append to')
+    parser.add_argument('--no-save', action='store_true', help='do not store the result')
+    parser.add_argument('--profile', help='profile the run with cProfile, dumping the stats here')
+    args = parser.parse_args(argv)
+
+    with instrument.profiled(args.profile):
+        result = runBenchmark(args.corpus, args.patterns or DEFAULT_PATTERNS, args.poems,
+                              args.crown, args.crowns, args.seed, args.sample, args.cold,
+                              args.startup)
+    printResult(result, previousResult(args.output, result['settings']))
+    if not args.no_save:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + '\n')
+
+if __name__ == "__main__":
+    main()
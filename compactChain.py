@@ -0,0 +1,207 @@
+import array
+import bisect
+import collections.abc
+import random
+import struct
+from markovify.chain import Chain, BEGIN, END
+
+# Markov chain stored in flat integer arrays.
+#
+# markovify keeps a chain as a dict from state tuples to dicts of successor
+# counts, around a hundred bytes of Python objects per transition, which a
+# forked worker also ends up copying as reference counts change. CompactChain
+# interns every word to an integer id and stores the chain CSR style: the
+# states, each packed into one integer, in a sorted array of keys, and for
+# state row r the successor ids in succ[offsets[r]:offsets[r+1]] with their
+# cumulative weights in the same slice of cum. Looking a state up is a
+# bisect over the keys, sampling a successor a bisect over the row's weights.
+# Successors keep markovify's order and iterating the chain gives the states
+# in the order of the model it was built from, so seeded runs produce the
+# same poems as on the dict chain.
+#
+# to_bytes() gives the whole chain as one buffer and from_buffer() reads one
+# back without copying the arrays, which stay views of the buffer. The arrays
+# are never written, so a chain loaded before forking stays shared with the
+# workers. `model` is a read-only mapping in markovify's compiled form,
+# {state: [words, cumulative weights]}, built per lookup, so code written
+# against markovify chains works unchanged.
+
+MAGIC = b'CCHAIN02'
+# Magic, state size and the number of words, states, transitions and word bytes
+HEADER = struct.Struct('<8sQQQQQ')
+
+class CompactModel(collections.abc.Mapping):
+    """Read-only view of a CompactChain in markovify's compiled model form"""
+
+    def __init__(self, chain):
+        self.chain = chain
+
+    def __getitem__(self, state):
+        row = self.chain.stateRow(state)
+        if row is None:
+            raise KeyError(state)
+        return self.chain.row(row)
+
+    def __contains__(self, state):
+        return self.chain.stateRow(state) is not None
+
+    def __iter__(self):
+        return (self.chain.stateOf(row) for row in self.chain.order)
+
+    def __len__(self):
+        return len(self.chain.keys)
+
+    def items(self):
+        return ((self.chain.stateOf(row), self.chain.row(row)) for row in self.chain.order)
+
+    def values(self):
+        return (self.chain.row(row) for row in self.chain.order)
+
+class CompactChain(Chain):
+    """markovify.Chain replacement backed by integer arrays"""
+
+    def __init__(self, corpus, state_size, model=None):
+        """Build from a corpus or from a markovify model, plain or compiled,
+        like markovify.Chain"""
+        if model is None:
+            model = Chain.build(self, corpus, state_size)
+        rows = [(state, self._successors(follow)) for state, follow in model.items()]
+
+        vocabulary = {END}
+        for state, (words, _) in rows:
+            vocabulary.update(state)
+            vocabulary.update(words)
+        words = sorted(vocabulary)
+        ids = {word: i for i, word in enumerate(words)}
+
+        # Rows sorted by key, `order` lists them in the model's order
+        keyed = sorted((self._pack([ids[w] for w in state], len(words)), n, follow)
+                       for n, (state, follow) in enumerate(rows))
+        order = array.array('i', [0] * len(keyed))
+        keys = array.array('q')
+        offsets = array.array('q', [0])
+        succ = array.array('i')
+        cum = array.array('q')
+        for row, (key, n, (follow, weights)) in enumerate(keyed):
+            order[n] = row
+            keys.append(key)
+            total = 0
+            for word, weight in zip(follow, weights):
+                total += weight
+                succ.append(ids[word])
+                cum.append(total)
+            offsets.append(len(succ))
+        self._setup(state_size, words, keys, offsets, succ, cum, order)
+
+    @staticmethod
+    def _successors(follow):
+        """(words, weights) of a plain or compiled successor entry"""
+        if isinstance(follow, list):
+            words, cumWeights = follow
+            return words, [b - a for a, b in zip([0] + cumWeights[:-1], cumWeights)]
+        return list(follow.keys()), list(follow.values())
+
+    @staticmethod
+    def _pack(ids, base):
+        key = 0
+        for i in ids:
+            key = key * base + i
+        return key
+
+    def _setup(self, state_size, words, keys, offsets, succ, cum, order, buffer=None):
+        self.state_size = state_size
+        self.words = words
+        self.wordIds = {word: i for i, word in enumerate(words)}
+        self.keys = keys
+        self.offsets = offsets
+        self.succ = succ
+        self.cum = cum
+        self.order = order
+        # Keeps the memory the arrays are views of alive
+        self.buffer = buffer
+        self.compiled = True
+        self.model = CompactModel(self)
+
+    def stateRow(self, state):
+        """Row of a state tuple of words, None if the chain does not have it"""
+        key = 0
+        base = len(self.words)
+        ids = self.wordIds
+        for word in state:
+            i = ids.get(word)
+            if i is None:
+                return None
+            key = key * base + i
+        keys = self.keys
+        row = bisect.bisect_left(keys, key)
+        if row < len(keys) and keys[row] == key:
+            return row
+        return None
+
+    def stateOf(self, row):
+        key = self.keys[row]
+        state = []
+        for _ in range(self.state_size):
+            key, i = divmod(key, len(self.words))
+            state.append(self.words[i])
+        return tuple(reversed(state))
+
+    def row(self, row):
+        """[successor words, cumulative weights] of a row"""
+        lo, hi = self.offsets[row], self.offsets[row + 1]
+        return [list(map(self.words.__getitem__, self.succ[lo:hi])), self.cum[lo:hi].tolist()]
+
+    def move(self, state):
+        row = self.stateRow(state)
+        if row is None:
+            raise KeyError(state)
+        lo, hi = self.offsets[row], self.offsets[row + 1]
+        r = random.random() * self.cum[hi - 1]
+        return self.words[self.succ[bisect.bisect(self.cum, r, lo, hi)]]
+
+    def compile(self, inplace=False):
+        # Read-only, so the chain can stand in for its compiled copy
+        return self
+
+    def precompute_begin_state(self):
+        pass
+
+    def vocabulary(self):
+        """All words the chain can emit"""
+        return set(self.words) - {BEGIN, END}
+
+    def to_bytes(self):
+        wordBytes = '\n'.join(self.words).encode('utf-8')
+        header = HEADER.pack(MAGIC, self.state_size, len(self.words), len(self.keys),
+                             len(self.succ), len(wordBytes))
+        # 8 byte arrays first, so every array stays aligned
+        return b''.join([header, bytes(self.keys), bytes(self.offsets), bytes(self.cum),
+                         bytes(self.succ), bytes(self.order), wordBytes])
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Chain whose arrays are views of buffer, e.g. bytes from to_bytes
+        or an mmap of a file holding them"""
+        view = memoryview(buffer)
+        magic, state_size, n_words, n_states, n_edges, n_bytes = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError('Not a compact chain')
+        pos = HEADER.size
+        arrays = []
+        for fmt, count in (('q', n_states), ('q', n_states + 1), ('q', n_edges),
+                           ('i', n_edges), ('i', n_states)):
+            size = count * struct.calcsize(fmt)
+            arrays.append(view[pos:pos + size].cast(fmt))
+            pos += size
+        keys, offsets, cum, succ, order = arrays
+        words = bytes(view[pos:pos + n_bytes]).decode('utf-8').split('\n')
+        if len(words) != n_words:
+            raise ValueError('Corrupt compact chain')
+
+        chain = cls.__new__(cls)
+        chain._setup(state_size, words, keys, offsets, succ, cum, order, buffer)
+        return chain
+
+    def __reduce__(self):
+        # Views cannot be pickled, the buffer is sent instead
+        return (CompactChain.from_buffer, (self.to_bytes(),))
@@ -7,6 +7,9 @@ class Config(object):
         self.markovify_input_dir = "./texts/"
         self.markovify_max_overlap_total = 25
         self.markovify_max_overlap_ratio = 0.8
+        self.model_cache_dir = "./cache/"
+        self.compact_chain = False # keep the Markov chains in flat integer arrays, see compactChain
+        self.shared_models = False # workers map the models from one published file, see sharedModels
 
         # Poem
         self.poem_avg_char_per_syl = 6 #pronouncing can calculate this accurately for each text
@@ -14,6 +17,37 @@ class Config(object):
         self.poem_second_syl_count = 7
 
         self.max_rhyme_attempts = 30
+        self.poem_max_attempts = None # sentence attempts before a poem gives up, None for no limit
+        self.job_max_attempts = 2000 # the same limit for the poems of service and batch jobs
+        self.syllable_walk = True # walk the chain to the syllable count instead of generate and reject
+        self.syllable_walk_max_steps = 2000
+        self.group_search = True # decode whole rhyme groups with a beam search first
+        self.group_beam_width = 4
+        self.group_time_budget = 10.0
+        self.group_max_expansions = 200 # budget of a seeded poem's group search, in place of the time budget
         self.is_test = False
+        self.seed = None # base seed for reproducible crowns, streams and batches, None for fresh output
         self.parallel_groups = False
         self.parallel_poems = False
+        self.pool_processes = None # worker processes, None for one per core
+        self.pool_max_tasks_per_child = None # recycle workers after this many tasks
+        self.pool_task_timeout = 600 # seconds to wait for a result before giving up on the pool
+        self.speculative_lines = 0 # candidate rhyming lines raced across processes per slot, 0 for off
+        self.speculative_timeout = 60 # seconds to wait for a round of candidates
+        self.line_reservoir = False # draw lines from a background filled reservoir first
+        self.reservoir_bucket_size = 32 # lines kept per syllable count and rhyme class
+        self.reservoir_max_lines = 20000
+        self.reservoir_prefill = 0 # lines generated up front when a reservoir is created
+        self.sentence_store = False # look rhyme groups up in an indexed store of lines first
+        self.sentence_store_generated = 2000 # lines walked from the models when building a store
+        self.sentence_store_corpus_lines = False # also store verbatim corpus clauses, which skip the overlap test
+        self.instrument_report = None # write counters and timers of a crown run to this JSON file
+        self.profile_path = None # profile crown runs with cProfile, dumping the stats to this file
+        self.log_level = "WARNING" # DEBUG logs every generation attempt
+        self.log_buffer = 200 # log records a pool worker buffers before writing them out
+
+        # Service
+        self.service_host = "127.0.0.1"
+        self.service_port = 8080
+        self.service_timeout = 30.0 # default deadline of a request in seconds
+        self.service_max_pending = 64 # distinct jobs in flight before requests are turned away
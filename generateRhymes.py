@@ -1,28 +1,114 @@
-import markovify
-import markovify.text
+import config
+import io
+import json
+import os
 import markoviRhyme as markoviRhyme
-
-def reverseCorpus(infile, outfile):
-
-    with open(infile, 'r') as f, open(outfile, 'w') as fout:
-        for s in f:
-            if s is not None:
-                words = s.split()
-                words.reverse()
-                #formattedPunc = words[0][-1] + words[0][:-1]
-                #words[0] = formattedPunc
-                fout.write("\n" + ' '.join(words))
-
-def buildModels(fFile, rFile):
-
-    with open(fFile) as f:
-        forwardText = f.read()
-
-    with open(rFile) as r:
-        revText = r.read()
-
-    forwardModel = markovify.Text(forwardText)
-    revModel = markoviRhyme.rhymeText(revText)
+import modelCache
+import rhyme
+
+WRITE_BUFFER = 1 << 20
+
+def reverseLines(lines):
+    for s in lines:
+        if s is not None:
+            words = s.split()
+            words.reverse()
+            #formattedPunc = words[0][-1] + words[0][:-1]
+            #words[0] = formattedPunc
+            yield "\n" + ' '.join(words)
+
+def reverseText(text):
+    """Reverse the words of every line of text, same output as reverseCorpus"""
+    return ''.join(reverseLines(io.StringIO(text)))
+
+def _manifestPath():
+    return os.path.join(config.Config().model_cache_dir, 'reverse_manifest.json')
+
+def _readManifest():
+    try:
+        with open(_manifestPath()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _writeManifest(manifest):
+    path = _manifestPath()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+def reverseCorpus(infile, outfile, force=False):
+    """Write the line-reversed infile to outfile, unless outfile was already
+    built from the current infile. Returns True if outfile was rewritten."""
+
+    manifest = _readManifest()
+    key = os.path.abspath(outfile)
+    entry = manifest.get(key)
+    stat = os.stat(infile)
+    source = {'source': os.path.abspath(infile), 'size': stat.st_size,
+              'mtime': stat.st_mtime}
+
+    if entry is not None and os.path.exists(outfile) and not force:
+        if all(entry.get(k) == v for k, v in source.items()):
+            return False
+        # Touched but possibly unchanged, fall back to the content hash
+        source['sha1'] = modelCache.corpusHash([infile])
+        if entry.get('sha1') == source['sha1']:
+            manifest[key] = source
+            _writeManifest(manifest)
+            return False
+
+    with open(infile, 'r') as f, open(outfile, 'w', buffering=WRITE_BUFFER) as fout:
+        fout.writelines(reverseLines(f))
+
+    source['sha1'] = source.get('sha1') or modelCache.corpusHash([infile])
+    manifest[key] = source
+    _writeManifest(manifest)
+    return True
+
+def reverseSentences(parsed_sentences):
+    """Reverse the word order of already parsed sentences. The word strings are
+    shared with the forward sentences."""
+    return [sentence[::-1] for sentence in parsed_sentences]
+
+def corpusFiles(corpus):
+    """Files of a corpus given as a text file or a directory of them"""
+    if os.path.isdir(corpus):
+        return sorted(os.path.join(corpus, name) for name in os.listdir(corpus)
+                      if name.endswith('.txt'))
+    return [corpus]
+
+def buildModels(fFile, rFile=None, compact=None):
+    """Build forward and reverse models for fFile, a text file or a directory
+    of them. Without rFile the reverse chain is built from the forward model's
+    parsed sentences, so the corpus is only split into sentences and words
+    once. With compact, config.compact_chain by default, the chains are
+    CompactChains."""
+
+    if compact is None:
+        compact = config.Config().compact_chain
+    paths = corpusFiles(fFile)
+    forwardModel = modelCache.loadModel(markoviRhyme.forwardText, paths, state_size=2,
+                                        compact=compact, syllables=True)
+    if rFile is None:
+        revModel = modelCache.loadModel(
+            markoviRhyme.rhymeText, paths, state_size=1, variant='sentences',
+            build=lambda: markoviRhyme.rhymeText(
+                None, parsed_sentences=reverseSentences(forwardModel.parsed_sentences)),
+            compact=compact)
+        revModel.line_reversed = False
+    else:
+        revModel = modelCache.loadModel(markoviRhyme.rhymeText, [rFile], state_size=1,
+                                        compact=compact)
+
+    # Build the rhyme index now so it is shared by any forked workers
+    rhyme.loadIndex()
+
+    # Both models draw from the same vocabulary, share one syllable counter,
+    # cached with the forward model
+    revModel.syllables = forwardModel.syllables
 
     return (forwardModel, revModel)
 
@@ -30,10 +116,14 @@ def uppercaseSentence(sentence):
     return sentence[0].upper() + sentence[1:]
 
 
-def formatReverseSentence(sentence):
-    rev = ' '.join(sentence.split()[::-1])
-    forwardRhyme = (' ').join(rev.split()[1:])
-    return uppercaseSentence(forwardRhyme)
+def formatReverseSentence(sentence, dropFirst=True):
+    """Turn a sentence from the reverse model back into forward order. Line
+    reversed corpora start every sentence with a word from the neighbouring
+    sentence, which dropFirst removes."""
+    rev = sentence.split()[::-1]
+    if dropFirst:
+        rev = rev[1:]
+    return uppercaseSentence(' '.join(rev))
 
 
 def buildRhymeSentence(fModel, revModel):
@@ -46,13 +136,14 @@ def buildRhymeSentence(fModel, revModel):
 
         if rhymeSentence:
             stanza.append(uppercaseSentence(startSentence))
-            forwardRhyme = formatReverseSentence(rhymeSentence)
+            forwardRhyme = formatReverseSentence(rhymeSentence, revModel.line_reversed)
             stanza.append(forwardRhyme)
             return stanza
             break
 
 def buildStanzas(lineCount, fFile, rFile):
     stanza = []
+    reverseCorpus(fFile, rFile)
     forwardModel, reverseModel = buildModels(fFile, rFile)
     lines = int(lineCount/2)
 
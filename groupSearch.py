@@ -0,0 +1,117 @@
+import math
+import string
+import time
+import generateRhymes as gr
+from markovify.chain import END
+
+# Beam search for the lines of a rhyme group.
+#
+# Given the anchor line of a group and the syllable targets of the remaining
+# lines, the lines are decoded jointly from the reverse model: every line
+# starts from a corpus start state rhyming with the anchor, is walked to its
+# exact syllable count, and must end on a rhyme word not used elsewhere in the
+# group. The beam keeps the `beam_width` most probable partial groups and
+# expands each with up to `expansions` candidate lines for the next slot.
+# Partial groups that cannot be extended drop out, and the search restarts if
+# the whole beam dies, until `time_budget` seconds have passed or the beam
+# has been expanded `max_expansions` times. Only the expansion budget gives
+# the same result on every run, so seeded generation uses it instead of time.
+
+DEFAULT_BEAM_WIDTH = 4
+DEFAULT_EXPANSIONS = 4
+DEFAULT_TIME_BUDGET = 10.0
+DEFAULT_MAX_STEPS = 2000
+
+def transitionLogProb(model, state, word):
+    follow = model[state]
+    if isinstance(follow, list):
+        # Compiled chains store [words, cumulative weights]
+        words, cumWeights = follow
+        i = words.index(word)
+        weight = cumWeights[i] - (cumWeights[i-1] if i else 0)
+        return math.log(weight / cumWeights[-1])
+    return math.log(follow[word] / sum(follow.values()))
+
+def lineScore(chain, words):
+    """Average log probability of the transitions that produced words"""
+    state = tuple(words[:chain.state_size])
+    score = 0.0
+    for word in words[chain.state_size:] + [END]:
+        score += transitionLogProb(chain.model, state, word)
+        state = state[1:] + (word,)
+    return score / (len(words) - chain.state_size + 1)
+
+def rhymeWordOf(words):
+    return words[0].strip(string.punctuation).lower()
+
+def formatLine(rev_model, words):
+    sent = gr.formatReverseSentence(rev_model.word_join(words), rev_model.line_reversed)
+    return ''.join(c for c in sent if c not in string.punctuation)
+
+def expand(rev_model, anchorWord, syls, used, expansions, max_steps, accept):
+    """Up to `expansions` scored candidate lines of `syls` syllables rhyming
+    with anchorWord and ending on words not in `used`"""
+    found = []
+    taken = set(used)
+    for _ in range(expansions):
+        init_state = rev_model.chooseRhymingWord(anchorWord, exclude=taken)
+        if init_state is None:
+            break
+        words = rev_model.walk_syllables(syls, init_state, max_steps,
+                                         rev_model.line_reversed, accept)
+        if words is None:
+            continue
+        word = rhymeWordOf(words)
+        taken.add(word)
+        found.append((lineScore(rev_model.chain, words), word, words))
+    return found
+
+def searchGroup(rev_model, anchor, targets, beam_width=DEFAULT_BEAM_WIDTH,
+                expansions=DEFAULT_EXPANSIONS, time_budget=DEFAULT_TIME_BUDGET,
+                max_steps=DEFAULT_MAX_STEPS, max_expansions=None, **kwargs):
+    """Return one line per syllable count in `targets`, all rhyming with the
+    anchor line and with each other's rhyme words distinct, or None if no
+    group was found within the budget. Either budget can be None for no
+    limit. `max_overlap_ratio` and `max_overlap_total` are passed to the
+    model's overlap test."""
+    anchorWord = anchor.split()[-1]
+    targets = [int(syls) for syls in targets]
+    if not targets:
+        return []
+
+    accept = None
+    if hasattr(rev_model, 'rejoined_text'):
+        mor = kwargs.get('max_overlap_ratio', 0.7)
+        mot = kwargs.get('max_overlap_total', 15)
+        accept = lambda words: rev_model.test_sentence_output(words, mor, mot)
+
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+    expanded = 0
+    def exhausted():
+        return ((deadline is not None and time.monotonic() >= deadline)
+                or (max_expansions is not None and expanded >= max_expansions))
+
+    while not exhausted():
+        # Beam entries are (total score, reversed lines, used rhyme words)
+        beam = [(0.0, [], frozenset([anchorWord.lower()]))]
+        for syls in targets:
+            candidates = []
+            for score, lines, used in beam:
+                if exhausted():
+                    return None
+                expanded += 1
+                for line_score, word, words in expand(rev_model, anchorWord, syls, used,
+                                                      expansions, max_steps, accept):
+                    candidates.append((score + line_score, lines + [words], used | {word}))
+            candidates.sort(key=lambda c: c[0], reverse=True)
+            beam = candidates[:beam_width]
+            if not beam:
+                break
+
+        if beam:
+            return [formatLine(rev_model, words) for words in beam[0][1]]
+
+        # Dead rhyme class, no point in retrying
+        if rev_model.chooseRhymingWord(anchorWord) is None:
+            return None
+    return None
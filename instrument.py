@@ -0,0 +1,118 @@
+import collections
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import time
+
+# Counters and timers for the hot paths of generation.
+#
+# Poem and Sonnet_crown count what their loops do (sentence attempts, lines
+# rejected for their syllable count or rhyme, dictionary misses, group
+# restarts, ...) and time the model calls, into one registry per process.
+# Counting is a dict update and timing two clock reads, cheap enough for the
+# inner loops. Forked workers start with an empty registry; a worker task
+# hands what it counted back with its result (drain) and the parent merges
+# it, so the report of a run covers every process that worked on it.
+#
+# report() gives the registry as a JSON-ready dict, writeReport() stores it,
+# and profiled() runs a block under cProfile and dumps the stats to a file
+# for pstats or snakeviz.
+
+_counters = collections.Counter()
+# name -> [calls, total seconds, longest call in seconds]
+_timers = {}
+
+def count(name, n=1):
+    _counters[name] += n
+
+def addTime(name, seconds, calls=1, longest=None):
+    entry = _timers.get(name)
+    if longest is None:
+        longest = seconds
+    if entry is None:
+        _timers[name] = [calls, seconds, longest]
+    else:
+        entry[0] += calls
+        entry[1] += seconds
+        if longest > entry[2]:
+            entry[2] = longest
+
+@contextlib.contextmanager
+def timer(name):
+    """Time the block under name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        addTime(name, time.perf_counter() - start)
+
+def timed(name):
+    """Decorator timing every call of a function under name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                addTime(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def snapshot():
+    """Raw counters and timers of this process, as accepted by merge"""
+    return {'counters': dict(_counters),
+            'timers': {name: list(entry) for name, entry in _timers.items()}}
+
+def merge(stats):
+    """Add a snapshot, e.g. one drained in a worker, to this process's registry"""
+    if not stats:
+        return
+    _counters.update(stats['counters'])
+    for name, (calls, seconds, longest) in stats['timers'].items():
+        addTime(name, seconds, calls, longest)
+
+def reset():
+    _counters.clear()
+    _timers.clear()
+
+def drain():
+    """Snapshot and reset, for a worker to return with a task's result"""
+    stats = snapshot()
+    reset()
+    return stats
+
+# A forked worker must not report its parent's counts again
+os.register_at_fork(after_in_child=reset)
+
+def report():
+    """Counters and timer summaries, sorted by name"""
+    timers = {}
+    for name, (calls, seconds, longest) in sorted(_timers.items()):
+        timers[name] = {'calls': calls, 'total_s': round(seconds, 6),
+                        'mean_ms': round(1000.0 * seconds / calls, 3),
+                        'max_ms': round(1000.0 * longest, 3)}
+    return {'counters': dict(sorted(_counters.items())), 'timers': timers}
+
+def writeReport(path, **extra):
+    """Write report() and the extra fields to path as JSON"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(dict(extra, **report()), f, indent=2)
+        f.write('\n')
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """Run the block under cProfile and dump the stats to path. Only this
+    process is profiled. Does nothing if path is None."""
+    if path is None:
+        yield None
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
@@ -0,0 +1,178 @@
+import collections
+import os
+import random
+import string
+import threading
+import generateRhymes as gr
+from syllableWalk import SyllableWalk
+
+# Reservoir of ready made lines, bucketed by syllable count and rhyme class.
+#
+# A background thread walks the forward and reverse models to every syllable
+# count in `syllables` and files each line under (syllables, rhyme class of
+# its last word), so a poem can take the lines it needs instead of walking
+# the chain. Each bucket keeps its newest `bucket_size` lines, older ones are
+# evicted, and the thread sleeps once `max_lines` lines are stored until
+# lines are taken again. The thread shares the interpreter with generation,
+# so it pays off when generation is idle, e.g. between service requests or
+# while a crown waits on its workers; fill() tops the reservoir up in the
+# foreground. The reservoir draws from its own random.Random, so a running
+# filler thread leaves the random module's sequence, and with it seeded
+# generation in the same process, alone.
+
+DEFAULT_SYLLABLES = range(4, 10)
+DEFAULT_BUCKET_SIZE = 32
+DEFAULT_MAX_LINES = 20000
+DEFAULT_MAX_STEPS = 2000
+
+class LineReservoir:
+    def __init__(self, forw_model, rev_model, syllables=DEFAULT_SYLLABLES,
+                 bucket_size=DEFAULT_BUCKET_SIZE, max_lines=DEFAULT_MAX_LINES,
+                 max_steps=DEFAULT_MAX_STEPS, **kwargs):
+        """`max_overlap_ratio` and `max_overlap_total` are passed to the
+        models' overlap test"""
+        self.forw_model = forw_model
+        self.rev_model = rev_model
+        self.syllables = list(syllables)
+        self.counter = forw_model.syllableCounter()
+        self.bucket_size = bucket_size
+        self.max_lines = max_lines
+        self.random = random.Random()
+        self.walk_args = dict(kwargs, max_steps=max_steps, rng=self.random)
+
+        # (syllables, rhyme class) -> newest lines, and the classes per count
+        self.buckets = {}
+        self.classes = collections.defaultdict(set)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        # Threads do not survive a fork, so the reservoir belongs to this process
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+        self.wanted.set()
+        self.stopped = False
+        self.thread = None
+
+    def rhymeClass(self, line):
+        return self.rev_model.rhymeClass(line.split()[-1])
+
+    def put(self, line, syls):
+        """File a line with `syls` syllables, evicting the oldest line of its
+        bucket if the bucket is full"""
+        key = (syls, self.rhymeClass(line))
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = collections.deque(maxlen=self.bucket_size)
+                self.classes[syls].add(key[1])
+            if len(bucket) == self.bucket_size:
+                self.size -= 1
+            bucket.append(line)
+            self.size += 1
+            if self.size >= self.max_lines:
+                self.wanted.clear()
+
+    def _pop(self, key, exclude=()):
+        """Newest line in the bucket whose last word is not in exclude, called
+        with the lock held"""
+        bucket = self.buckets.get(key)
+        if not bucket:
+            return None
+        for i in range(len(bucket) - 1, -1, -1):
+            line = bucket[i]
+            if line.split()[-1].lower() not in exclude:
+                del bucket[i]
+                self.size -= 1
+                self.wanted.set()
+                return line
+        return None
+
+    def _count(self, result):
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def take(self, syls):
+        """A line of `syls` syllables with any rhyme class, or None"""
+        with self.lock:
+            classes = [c for c in self.classes[syls] if self.buckets[(syls, c)]]
+            line = self._pop((syls, self.random.choice(classes))) if classes else None
+            return self._count(line)
+
+    def takeRhyming(self, syls, word, exclude=()):
+        """A line of `syls` syllables rhyming with word and not ending on word
+        or on any of the lower case words in exclude, or None"""
+        exclude = set(exclude) | {word.lower()}
+        with self.lock:
+            return self._count(self._pop((syls, self.rev_model.rhymeClass(word)), exclude))
+
+    def takeAnchor(self, syls, partners):
+        """A line of `syls` syllables whose rhyme class has enough lines left
+        for the syllable counts in partners, or None"""
+        needed = collections.Counter(partners)
+        needed[syls] += 1
+        with self.lock:
+            classes = [c for c in self.classes[syls] if c is not None]
+            self.random.shuffle(classes)
+            for c in classes:
+                if all(len(self.buckets.get((s, c), ())) >= n for s, n in needed.items()):
+                    return self._count(self._pop((syls, c)))
+            return self._count(None)
+
+    def generate(self, syls):
+        """Walk one line of `syls` syllables from either model, None if the
+        walk failed"""
+        if self.random.random() < 0.5:
+            line = self.forw_model.make_syllable_sentence(syls, **self.walk_args)
+        else:
+            # A reverse walk from the start of a line picks the rhyme word first
+            line = SyllableWalk.make_syllable_sentence(
+                self.rev_model, syls, None, drop_last=self.rev_model.line_reversed,
+                **self.walk_args)
+            if line is not None:
+                line = gr.formatReverseSentence(line, self.rev_model.line_reversed)
+        if not line:
+            return None
+        line = ''.join(c for c in line if c not in string.punctuation)
+        if not line.split() or self.counter.countLine(line) != syls:
+            return None
+        return line
+
+    def fill(self, n):
+        """Generate n lines for the emptiest syllable counts"""
+        for _ in range(n):
+            with self.lock:
+                totals = {s: sum(len(self.buckets[(s, c)]) for c in self.classes[s])
+                          for s in self.syllables}
+            syls = min(self.syllables, key=lambda s: totals[s])
+            line = self.generate(syls)
+            if line is not None:
+                self.put(line, syls)
+
+    def _run(self):
+        while not self.stopped:
+            self.wanted.wait()
+            if not self.stopped:
+                self.fill(1)
+
+    def start(self):
+        """Start refilling in a background thread"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.wanted.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        return {'lines': self.size, 'buckets': len(self.buckets),
+                'hits': self.hits, 'misses': self.misses}
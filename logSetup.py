@@ -0,0 +1,62 @@
+import logging
+import logging.handlers
+import sys
+import config
+
+# Logging for the generation modules.
+#
+# Modules log through logging.getLogger(__name__): progress at INFO, the
+# details of every attempt at DEBUG. Loops that log per attempt check
+# isEnabledFor once and skip the call altogether otherwise, so below DEBUG
+# they do no formatting or I/O. The level is config.log_level unless given.
+#
+# Pool workers buffer their records instead of writing each one to the
+# shared stderr. A worker's buffer is written out in one piece when it is
+# full, on an error, or at the end of each task (flushLogs), so the lines of
+# one task stay together.
+
+LOG_FORMAT = '%(asctime)s %(processName)s %(name)s %(levelname)s: %(message)s'
+
+class BufferedStderrHandler(logging.handlers.BufferingHandler):
+    """Buffers records and writes them to stderr with a single write per flush"""
+
+    def __init__(self, capacity, flushLevel=logging.ERROR):
+        super().__init__(capacity)
+        self.flushLevel = flushLevel
+
+    def shouldFlush(self, record):
+        return len(self.buffer) >= self.capacity or record.levelno >= self.flushLevel
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                text = ''.join(self.format(record) + '\n' for record in self.buffer)
+                self.buffer.clear()
+                sys.stderr.write(text)
+                sys.stderr.flush()
+        finally:
+            self.release()
+
+def _install(handler, level):
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+        old.close()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root.addHandler(handler)
+    if level is not None:
+        root.setLevel(level)
+
+def configureLogging(level=None):
+    """Log to stderr at level, a name or number, config.log_level by default"""
+    _install(logging.StreamHandler(sys.stderr), level or config.Config().log_level)
+
+def workerLogging(capacity=None):
+    """Buffer this process's records, keeping the inherited level"""
+    capacity = capacity or config.Config().log_buffer
+    _install(BufferedStderrHandler(capacity), None)
+
+def flushLogs():
+    for handler in logging.getLogger().handlers:
+        handler.flush()
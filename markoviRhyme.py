@@ -1,22 +1,46 @@
 import rhyme
+import rhymeDegree
 from markovify.chain import Chain, BEGIN, END
 import markovify.text
+import bisect
+import logging
 import random
+import re
+import string
+from syllableWalk import SyllableWalk
 
 # Derived class from markovify.Text to generate rhyming sentences from
-# a reversed markov chain
+# a reversed markov chain. Rhyming start states are looked up by rhyme class,
+# the word's last phonemes; a word whose class has no other start state
+# falls back to the near rhymes that rhymeDegree.is_rhyme_pair accepts.
 
 DEFAULT_TRIES = 10
 DEFAULT_MAX_OVERLAP_RATIO = 0.7
 DEFAULT_MAX_OVERLAP_TOTAL = 15
+DEFAULT_RHYME_ORDER = 2
 
+log = logging.getLogger(__name__)
 
-class rhymeText(markovify.Text):
-    def __init__(self, input_text, state_size=1, chain=None, parsed_sentences=None, retain_original=True, well_formed=True, reject_reg=''):
+
+def _rhymeVowel(pronun):
+    """First vowel of a pronunciation's rhyming part, without its stress"""
+    return next((phone[:2] for phone in rhyme.rhymingPart(pronun) if phone[-1].isdigit()), None)
+
+
+class forwardText(SyllableWalk, markovify.Text):
+    """markovify.Text that can also walk to an exact syllable count"""
+
+
+class rhymeText(SyllableWalk, markovify.Text):
+    def __init__(self, input_text, state_size=1, chain=None, parsed_sentences=None, retain_original=True, well_formed=True, reject_reg='', rhyme_order=DEFAULT_RHYME_ORDER, rhyme_table=None):
+        """rhyme_table can pass the rhymeTable of a model with the same chain
+        and rhyme order, instead of building it"""
         can_make_sentences = parsed_sentences is not None or input_text is not None
         self.retain_original = retain_original and can_make_sentences
         self.state_size = state_size
         self.rhymeWord = ""
+        # Corpus was reversed line by line rather than sentence by sentence
+        self.line_reversed = True
 
         self.well_formed = well_formed
         if well_formed and reject_reg != '':
@@ -33,36 +57,133 @@ class rhymeText(markovify.Text):
                 parsed = parsed_sentences or self.generate_corpus(input_text)
             self.chain = chain or Chain(parsed, state_size)
 
-    def chooseRhymingWord(self, rhymeWord, matchedWord=None):
-        rhymeList = rhyme.generateRhymes(rhymeWord, 2)
-        if rhymeList is None:
+        self.rhyme_order = rhyme_order
+        # Near rhyme start states by word, see nearRhymes
+        self.nearRhymeTable = {}
+        if rhyme_table is None:
+            self.buildRhymeTable()
+        else:
+            self.rhymeTable = rhyme_table
+
+    def rhymeClass(self, word):
+        """Rhyme class of a word, its last `rhyme_order` phonemes, or None if the
+        word is not in the pronunciation dictionary"""
+        pronun = rhyme.pronunciationDict().get(word.lower())
+        if pronun is None:
             return None
-        random.shuffle(rhymeList)
-        for word in rhymeList:
-            formatted = (word,)
-            formattedPunc = (word + '.',)
+        return tuple(pronun[-self.rhyme_order:])
+
+    def buildRhymeTable(self):
+        """Group the start states that exist in the chain by the rhyme class of
+        their first word, with cumulative weights for sampling. Rhyme classes
+        missing from the table have no rhyming start state in the corpus."""
+        table = {}
+        for state, follow in self.chain.model.items():
+            if BEGIN in state:
+                continue
+            word = state[0].rstrip(string.punctuation).lower()
+            rhymeClass = self.rhymeClass(word) if word else None
+            if rhymeClass is None:
+                continue
+            # Compiled chains store [words, cumulative weights]
+            weight = follow[1][-1] if isinstance(follow, list) else sum(follow.values())
+            states, words, cumWeights = table.setdefault(rhymeClass, ([], [], []))
+            states.append(state)
+            words.append(word)
+            cumWeights.append(weight + (cumWeights[-1] if cumWeights else 0))
+        self.rhymeTable = table
 
-            if formatted in self.chain.model:
-                matchedWord = formatted
-                return matchedWord
+    def hasRhymes(self, rhymeWord):
+        """Return true if the corpus has a start state rhyming with rhymeWord"""
+        candidates = self.rhymeTable.get(self.rhymeClass(rhymeWord))
+        if candidates is None:
+            return False
+        rhymeWord = rhymeWord.lower()
+        return any(word != rhymeWord for word in candidates[1])
 
-            elif formattedPunc in self.chain.model:
-                macthedWord = formattedPunc
-                return matchedWord
+    def nearRhymes(self, rhymeWord):
+        """Start states whose first word rhymes with rhymeWord by
+        rhymeDegree.is_rhyme_pair, as (states, words, cumulative weights)
+        like a rhymeTable entry. Cached per word."""
+        rhymeWord = rhymeWord.lower()
+        table = self.nearRhymeTable.get(rhymeWord)
+        if table is not None:
+            return table
+        table = ([], [], [])
+        pronunciations = rhyme.pronunciationDict()
+        pronun = pronunciations.get(rhymeWord)
+        if pronun is not None:
+            # Rhymes share the vowel of the rhyming part
+            vowel = _rhymeVowel(pronun)
+            states, words, cumWeights = table
+            for candidates in self.rhymeTable.values():
+                previous = 0
+                for state, word, cumWeight in zip(*candidates):
+                    weight, previous = cumWeight - previous, cumWeight
+                    other = pronunciations.get(word)
+                    if (word == rhymeWord or other is None
+                            or _rhymeVowel(other) != vowel
+                            or not rhymeDegree.is_rhyme_pair(rhymeWord, word)):
+                        continue
+                    states.append(state)
+                    words.append(word)
+                    cumWeights.append(weight + (cumWeights[-1] if cumWeights else 0))
+        self.nearRhymeTable[rhymeWord] = table
+        return table
 
-        return None
+    def canRhyme(self, rhymeWord):
+        """Return true if chooseRhymingWord can find a start state for
+        rhymeWord, by rhyme class or near rhyme"""
+        return self.hasRhymes(rhymeWord) or bool(self.nearRhymes(rhymeWord)[0])
+
+    def chooseRhymingWord(self, rhymeWord, exclude=()):
+        """Sample a start state rhyming with rhymeWord, weighted by frequency.
+        Words in `exclude` (lower case) are never chosen. Words whose rhyme
+        class has no other word in the corpus get one of their near rhymes.
+        Returns None if there is neither."""
+        if self.hasRhymes(rhymeWord):
+            candidates = self.rhymeTable[self.rhymeClass(rhymeWord)]
+        else:
+            candidates = self.nearRhymes(rhymeWord)
+        if not candidates[0]:
+            return None
+        states, words, cumWeights = candidates
+        rhymeWord = rhymeWord.lower()
+
+        for _ in range(DEFAULT_TRIES):
+            i = bisect.bisect(cumWeights, random.random() * cumWeights[-1])
+            if words[i] != rhymeWord and words[i] not in exclude:
+                return states[i]
+
+        # Rhyme class dominated by excluded words, pick among the others
+        others = [i for i, word in enumerate(words)
+                  if word != rhymeWord and word not in exclude]
+        if not others:
+            return None
+        return states[random.choice(others)]
 
     def make_short_sentence(self, max_chars, rhymeWord, min_chars=0, **kwargs):
 
         tries = kwargs.get('tries', DEFAULT_TRIES)
         init_state = self.chooseRhymingWord(rhymeWord)
 
-        print("-----")
-        print(rhymeWord)
-        print(init_state)
-        print("-----")
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Start state for %r: %r', rhymeWord, init_state)
+
+        if init_state is None:
+            return None
 
         for _ in range(tries):
             sentence = self.make_sentence(init_state=init_state, **kwargs)
             if sentence and len(sentence) <= max_chars and len(sentence) >= min_chars:
                 return sentence
+
+    def make_syllable_sentence(self, syls, rhymeWord, **kwargs):
+        """Reverse sentence of exactly `syls` syllables starting with a word
+        rhyming with rhymeWord. The word dropped by formatReverseSentence on
+        line reversed corpora is not counted."""
+        init_state = self.chooseRhymingWord(rhymeWord)
+        if init_state is None:
+            return None
+        kwargs.setdefault('drop_last', self.line_reversed)
+        return SyllableWalk.make_syllable_sentence(self, syls, init_state, **kwargs)
@@ -1,11 +1,8 @@
 import markovify
+import modelCache
 
-# Get raw text as string.
-with open("sherlock.txt") as f:
-    text = f.read()
-
-# Build the model.
-text_model = markovify.Text(text)
+# Build the model, or load it from the cache if the text is unchanged.
+text_model = modelCache.loadModel(markovify.Text, ["texts/sherlock.txt"])
 
 # Print five randomly-generated sentences
 for i in range(5):
@@ -0,0 +1,155 @@
+import config
+import compactChain
+import glob
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import syllableCount
+from markovify.chain import Chain
+
+# On-disk cache of Markov text models.
+#
+# A cache file starts with a marshal record of the model's settings and
+# parsed sentences. A plain markovify chain is part of the record in compiled
+# form, and loading unmarshals it into a fresh dict, which takes most of a
+# second for a novel. A compact chain (see compactChain) follows the record as
+# its to_bytes buffer, on an 8 byte boundary, and is used in place: the file
+# is memory mapped and the chain's arrays are views of the mapping, so loading
+# it costs no more than mapping the file. Cache files are keyed by model
+# class, state size and the content hash of every corpus file, so editing any
+# input builds a new entry and removes the stale one. Compact chains are
+# cached separately from plain ones. Tables derived from the chain that take
+# long to rebuild, the syllable counts of its vocabulary and the rhyme table of
+# a rhymeText, are part of the record as well.
+
+CACHE_VERSION = 3
+MAGIC = b'MCACHE03'
+# Magic and the length of the marshal record
+HEADER = struct.Struct('<8sQ')
+ALIGN = 8
+
+def corpusHash(paths):
+    """SHA-1 over the contents of all corpus files, in order"""
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def readCorpus(paths):
+    """Concatenated text of all corpus files"""
+    text = ''
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            text += f.read()
+    return text
+
+def cachePrefix(model_class, paths, state_size, variant=''):
+    """Cache file prefix shared by all versions of the same corpus files"""
+    names = '\0'.join(os.path.abspath(path) for path in paths)
+    slot = hashlib.sha1(names.encode('utf-8')).hexdigest()[:12]
+    name = model_class.__name__ + ('-' + variant if variant else '')
+    return '%s-%d-%s-' % (name, state_size, slot)
+
+def dumpModel(model, path):
+    """Write a model to path atomically"""
+    compact = isinstance(model.chain, compactChain.CompactChain)
+    syllables = getattr(model, 'syllables', None)
+    record = marshal.dumps({
+        'version': CACHE_VERSION,
+        'state_size': model.state_size,
+        'compact': compact,
+        'chain': None if compact else model.chain.compile().model,
+        'sentences': model.parsed_sentences,
+        'syllables': None if syllables is None else syllables.table(),
+        'rhyme_order': getattr(model, 'rhyme_order', None),
+        'rhyme_table': getattr(model, 'rhymeTable', None),
+    })
+    record += b'\0' * (-(HEADER.size + len(record)) % ALIGN)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(record)))
+        f.write(record)
+        if compact:
+            f.write(model.chain.to_bytes())
+    os.replace(tmp, path)
+
+def loadRecord(path):
+    """Read a cache file, returning None if it is unusable. The chain of a
+    compact record is a view of the memory mapped file."""
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, size = HEADER.unpack_from(mm)
+        if magic != MAGIC:
+            raise ValueError('Not a model cache file')
+        record = marshal.loads(mm[HEADER.size:HEADER.size + size])
+        if not isinstance(record, dict) or record.get('version') != CACHE_VERSION:
+            raise ValueError('Unsupported model cache version')
+    except (ValueError, EOFError, TypeError, struct.error):
+        mm.close()
+        return None
+    if record.get('compact'):
+        # The view keeps the mapping open as long as the chain uses it
+        record['chain'] = memoryview(mm)[HEADER.size + size:]
+    else:
+        mm.close()
+    return record
+
+def modelFromRecord(model_class, record):
+    state_size = record['state_size']
+    if record.get('compact'):
+        chain = compactChain.CompactChain.from_buffer(record['chain'])
+    else:
+        chain = Chain(None, state_size, model=record['chain'])
+    kwargs = {}
+    if record.get('rhyme_table') is not None:
+        kwargs.update(rhyme_order=record['rhyme_order'], rhyme_table=record['rhyme_table'])
+    model = model_class(None, state_size=state_size, chain=chain,
+                        parsed_sentences=record['sentences'], **kwargs)
+    if record.get('syllables') is not None:
+        model.syllables = syllableCount.SyllableCounter.fromCounts(*record['syllables'])
+    return model
+
+def loadModel(model_class, paths, state_size=2, variant='', build=None, compact=False,
+              syllables=False):
+    """Return a model_class instance for the corpus files in paths, loading it
+    from the cache if none of the files changed. `build` is called without
+    arguments on a cache miss, by default the model is built from the
+    concatenated files. `variant` separates models built differently from the
+    same files. With compact the model's chain is a CompactChain. With
+    syllables the model's `syllables` is a SyllableCounter for its vocabulary."""
+    cache_dir = config.Config().model_cache_dir
+    if compact:
+        variant = variant + '-compact' if variant else 'compact'
+    prefix = cachePrefix(model_class, paths, state_size, variant)
+    path = os.path.join(cache_dir, prefix + corpusHash(paths)[:16] + '.marshal')
+
+    if os.path.exists(path):
+        record = loadRecord(path)
+        if record is not None and (record.get('syllables') is not None or not syllables):
+            return modelFromRecord(model_class, record)
+
+    if build is None:
+        model = model_class(readCorpus(paths), state_size=state_size)
+    else:
+        model = build()
+    if compact:
+        model.chain = compactChain.CompactChain(None, state_size, model=model.chain.model)
+    if syllables:
+        model.syllables = syllableCount.SyllableCounter(
+            syllableCount.chainVocabulary(model.chain))
+
+    # Drop entries for earlier versions of the corpus
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in glob.glob(os.path.join(glob.escape(cache_dir), glob.escape(prefix) + '*')):
+        os.remove(stale)
+    dumpModel(model, path)
+    return model
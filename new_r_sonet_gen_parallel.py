@@ -1,15 +1,28 @@
-import pronouncing as pnc
+import argparse
+import contextlib
 import os
-import markovify
 import config
 import string
-import syllabifyARPA as ARPA
-import re
-from multiprocessing import Pool
+import logging
+from rhymeDegree import is_rhyme_pair
+from multiprocessing import Pool, TimeoutError, current_process, parent_process
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import sys # For debugging exit
+import gc
 
 import random
+import itertools
+import collections
 import generateRhymes as gr
+import rhyme
+import groupSearch
+import instrument
+import lineReservoir
+import logSetup
+import sentenceStore
+import sharedModels
+import seeding
+import syllableCount
 
 #TODO: Implement new rhyming method
 #TODO: Allow lines with more than 9 syllables
@@ -17,20 +30,252 @@ import generateRhymes as gr
 #TODO: Don't regenerate the model every time.
 #TODO: Handle case of rhymes only appearing once to handle delta field
 
+DEFAULT_FILE = 'texts/verne.txt'
+DEFAULT_PATTERN = 'ABCB7676'
+# Masters generated before a crown settles for lines without corpus rhymes
+MASTER_TRIES = 5
+# Syllable counts the walker can produce, one digit per line of a pattern
+SYLLABLE_COUNTS = '123456789'
+
+log = logging.getLogger(__name__)
+
+class GenerationError(RuntimeError):
+    """A poem gave up after its limit of sentence attempts"""
+
+@contextlib.contextmanager
+def attempt_limit(limit):
+    """Make the poems generated in the block give up with GenerationError
+    after limit sentence attempts each, for jobs that must not hold a worker
+    forever. Overrides config.poem_max_attempts, which is off by default."""
+    global _attempt_limit
+    previous, _attempt_limit = _attempt_limit, limit
+    try:
+        yield
+    finally:
+        _attempt_limit = previous
+
+def _last_words(lines):
+    """Lower case last words of the lines that are set"""
+    return set(line.split()[-1].lower() for line in lines if line)
+
+def valid_pattern(pattern):
+    """Whether pattern is rhyme letters followed by as many syllable counts"""
+    half = len(pattern) // 2
+    return (bool(pattern) and len(pattern) % 2 == 0
+            and not any(c.isdigit() for c in pattern[:half])
+            and all(c in SYLLABLE_COUNTS for c in pattern[half:]))
+
+# Text models of a generation worker, loaded once per process by _init_worker.
+# Workers forked from a process that already loaded them inherit them.
+_worker_models = {}
+_pool = None
+_pool_key = None
+_executor = None
+_executor_key = None
+_reservoir = None
+# Attempt limit of the poems generated inside attempt_limit()
+_attempt_limit = None
+
+def _init_worker(fFile):
+    """Pool initializer, load the models for fFile unless already present.
+    In a worker process log records are buffered, see logSetup."""
+    if parent_process() is not None and not _worker_models.get('logging'):
+        logSetup.workerLogging()
+        _worker_models['logging'] = True
+    if _worker_models.get('file') != fFile:
+        cfg = config.Config()
+        if cfg.shared_models:
+            # Views of the published model file, shared by every process
+            forw_model, rev_model = sharedModels.loadShared(fFile).models()
+        else:
+            forw_model, rev_model = gr.buildModels(fFile)
+        _worker_models.update(file=fFile, forw=forw_model, rev=rev_model, store=None)
+        if cfg.sentence_store:
+            # Memory mapped, so forked workers share it
+            _worker_models['store'] = sentenceStore.loadStore(
+                gr.corpusFiles(fFile), (forw_model, rev_model), cfg.sentence_store_generated,
+                corpus_lines=cfg.sentence_store_corpus_lines,
+                max_overlap_ratio=cfg.markovify_max_overlap_ratio,
+                max_overlap_total=cfg.markovify_max_overlap_total)
+
+def _process_reservoir(fmodel, rmodel):
+    """Line reservoir of this process for the given models, created and
+    started on first use if config.line_reservoir is set. Forked workers do
+    not inherit the parent's filler thread, so they start their own."""
+    global _reservoir
+    cfg = config.Config()
+    if not cfg.line_reservoir or fmodel is None or rmodel is None:
+        return None
+    if (_reservoir is None or _reservoir.pid != os.getpid()
+            or _reservoir.forw_model is not fmodel or _reservoir.rev_model is not rmodel):
+        if _reservoir is not None and _reservoir.pid == os.getpid():
+            _reservoir.stop()
+        _reservoir = lineReservoir.LineReservoir(
+            fmodel, rmodel,
+            bucket_size=cfg.reservoir_bucket_size,
+            max_lines=cfg.reservoir_max_lines,
+            max_steps=cfg.syllable_walk_max_steps,
+            max_overlap_ratio=cfg.markovify_max_overlap_ratio,
+            max_overlap_total=cfg.markovify_max_overlap_total
+        )
+        _reservoir.fill(cfg.reservoir_prefill)
+        _reservoir.start()
+    return _reservoir
+
+def _task_stats():
+    """At the end of a task in a worker, write out its buffered log records
+    and drain its instrument stats to return with the result"""
+    logSetup.flushLogs()
+    return instrument.drain()
+
+def _sonnet_task(task):
+    """Generate a poem in a worker from a task descriptor
+    (pattern, start line, end line, seed)"""
+    pattern, start_line, end_line, seed = task
+    fixed = [line for line in (start_line, end_line) if line is not None]
+    return Poem(pattern, _worker_models['forw'], _worker_models['rev'], *fixed, seed=seed)
+
+def _indexed_sonnet_task(item):
+    """(index, poem, instrument stats) for an (index, task descriptor) pair"""
+    index, task = item
+    poem = _sonnet_task(task)
+    return index, poem, _task_stats()
+
+def _group_task(task):
+    """Build a rhyme group in a worker from a task descriptor
+    (build method name, group, seed), returning the group and instrument stats"""
+    method, group, seed = task
+    seeding.seedRandom(seed)
+    poem = Poem(None, _worker_models['forw'], _worker_models['rev'], seed=seed)
+    group = getattr(poem, method)(group)
+    return group, _task_stats()
+
+def _line_task(task):
+    """Generate a candidate rhyming line in a worker from a task descriptor
+    (syllables, rhyme word, seed), returning the line and instrument stats"""
+    syls, rhymeWord, seed = task
+    seeding.seedRandom(seed)
+    poem = Poem(None, _worker_models['forw'], _worker_models['rev'])
+    sent = poem._new_rhyming_sentence(syls, rhymeWord)
+    return sent, _task_stats()
+
+def freeze_models():
+    """Load the pronunciation dictionaries, which are otherwise loaded on
+    first use, and move everything loaded so far out of reach of the garbage
+    collector before forking workers. A collection in a worker would
+    otherwise write to every page holding them, leaving each worker with a
+    private copy."""
+    rhyme.loadIndex()
+    syllableCount.loadDictionary()
+    gc.collect()
+    gc.freeze()
+
+def get_pool(fFile, processes=None, maxtasksperchild=None):
+    """Long-lived generation pool whose workers hold the models for fFile"""
+    global _pool, _pool_key
+    key = (fFile, processes, maxtasksperchild)
+    if _pool is None or _pool_key != key:
+        close_pool()
+        freeze_models()
+        _pool = Pool(processes, initializer=_init_worker, initargs=(fFile,),
+                     maxtasksperchild=maxtasksperchild)
+        _pool_key = key
+    return _pool
+
+def close_pool(terminate=False):
+    """Shut the generation pool down, waiting for running tasks unless
+    terminate is set"""
+    global _pool, _pool_key
+    if _pool is not None:
+        if terminate:
+            _pool.terminate()
+        else:
+            _pool.close()
+        _pool.join()
+        _pool = None
+        _pool_key = None
+
+def get_executor(fFile, processes=None):
+    """Executor for speculative line generation, whose workers hold the
+    models for fFile. Unlike the pool, its queued tasks can be cancelled."""
+    global _executor, _executor_key
+    if _executor is None or _executor_key != (fFile, processes):
+        close_executor()
+        freeze_models()
+        _executor = ProcessPoolExecutor(processes, initializer=_init_worker,
+                                        initargs=(fFile,))
+        _executor_key = (fFile, processes)
+    return _executor
+
+def close_executor():
+    global _executor, _executor_key
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+        _executor_key = None
+
+def generate_stream(pattern, fFile=DEFAULT_FILE, count=None, pool=None, prefetch=None,
+                    seed=None):
+    """Yield Poem objects with the given pattern, `count` of them or without
+    end. With a pool from get_pool, up to `prefetch` poems (twice the worker
+    count by default) are generated ahead and yielded in submission order,
+    so memory stays bounded however long the stream runs. The n-th poem is
+    seeded from `seed`, config.seed by default, so a seeded stream is the
+    same with or without a pool."""
+    _init_worker(fFile)
+    if seed is None:
+        seed = config.Config().seed
+    produced = itertools.count() if count is None else range(count)
+    if pool is None:
+        for n in produced:
+            yield Poem(pattern, _worker_models['forw'], _worker_models['rev'],
+                       seed=seeding.deriveSeed(seed, 'stream', n))
+        return
+
+    def collect(result):
+        _, poem, stats = result.get()
+        instrument.merge(stats)
+        return poem
+
+    prefetch = prefetch or 2 * (config.Config().pool_processes or os.cpu_count() or 1)
+    pending = collections.deque()
+    for n in produced:
+        if len(pending) >= prefetch:
+            yield collect(pending.popleft())
+        task = (pattern, None, None, seeding.deriveSeed(seed, 'stream', n))
+        pending.append(pool.apply_async(_indexed_sonnet_task, ((n, task),)))
+    while pending:
+        yield collect(pending.popleft())
+
 class Sonnet_crown:
     """An autogenerated crown of sonnets. If the base poem has n lines, there will be
     n sonnets and one master sonnet"""
 
-    def __init__(self, base_pattern, prev_master=None):
-        """Generate master sonnet"""
+    def __init__(self, base_pattern, prev_master=None, fmodel=None, rmodel=None,
+                 fFile=DEFAULT_FILE, seed=None):
+        """Generate master sonnet. Preloaded models for fFile can be passed,
+        otherwise they are loaded from the model cache. The master and every
+        subsonnet get seeds derived from `seed`, config.seed by default."""
         self.config = config.Config()
         is_test = self.config.is_test
+        self.seed = seed if seed is not None else self.config.seed
 
         # Generate text model
-        fFile = 'texts/verne.txt'
-        rFile = 'texts/verne_reverse.txt'
-        gr.reverseCorpus(fFile,rFile)
-        self.forw_model, self.rev_model = gr.buildModels(fFile, rFile)
+        self.fFile = fFile
+        if fmodel is None or rmodel is None:
+            _init_worker(self.fFile)
+            fmodel, rmodel = _worker_models['forw'], _worker_models['rev']
+        self.forw_model = fmodel
+        self.rev_model = rmodel
+
+        # Workers are forked after the models are loaded, so they share them
+        self.pool = None
+        if self.config.parallel_poems or self.config.parallel_groups:
+            self.pool = get_pool(self.fFile, self.config.pool_processes,
+                                 self.config.pool_max_tasks_per_child)
+        self.executor = None
+        if self.config.speculative_lines:
+            self.executor = get_executor(self.fFile, self.config.pool_processes)
 
         self.pattern = base_pattern
         # Count number of lines in sonnet
@@ -40,10 +285,11 @@ class Sonnet_crown:
         self.subsonnets = [None] * self.line_number
 
         # Generate master sonnet if not given
-        print("Generating master sonnet")
+        log.info("Generating master sonnet")
         prev_master = None
         if prev_master == None:
-            self.master = Poem(base_pattern, self.forw_model, self.rev_model)
+            with instrument.timer('master'):
+                self.master = self._new_master(base_pattern)
         else:
             self.master = prev_master
 
@@ -63,35 +309,99 @@ class Sonnet_crown:
 
         # self.master_lines = master2_lines
 
-    def generate_single_sonnet(self, line):
-        """Generate a single sub-sonnet of the master sonnet starting with line
-        and ending with line + 1"""
-        print('Generating sonnet from line ' + str(line))
+    def _new_master(self, base_pattern):
+        """Master sonnet whose every line the reverse model can rhyme with,
+        since each is a fixed line of two subsonnets. Up to MASTER_TRIES
+        masters are generated, each from its own derived seed."""
+        for attempt in range(MASTER_TRIES):
+            # The first master keeps the seed crowns had before retries
+            keys = ('master',) if attempt == 0 else ('master', attempt)
+            master = Poem(base_pattern, self.forw_model, self.rev_model,
+                          pool=self.pool, executor=self.executor,
+                          seed=seeding.deriveSeed(self.seed, *keys))
+            lines = master.poem.split('\n')
+            if all(self.rev_model.canRhyme(line.split()[-1]) for line in lines):
+                return master
+            instrument.count('master_retries')
+            log.info("Master line without rhymes in the corpus, generating a new master")
+        return master
+
+    def sonnet_task(self, line):
+        """Task descriptor (pattern, start line, end line, seed) of the sub-sonnet
+        starting with line and ending with line + 1"""
         start_line = self.master_lines[line]
         if line == self.line_number-1:
             # Check if we need to loop back to first line:
             end_line = self.master_lines[0]
         else:
             end_line = self.master_lines[line+1]
+        return (self.pattern, start_line, end_line,
+                seeding.deriveSeed(self.seed, 'subsonnet', line))
 
-        poem = Poem(self.pattern, self.forw_model, self.rev_model, start_line, end_line)
+    def generate_single_sonnet(self, line):
+        """Generate a single sub-sonnet of the master sonnet starting with line
+        and ending with line + 1"""
+        log.info('Generating sonnet from line %d', line)
+        pattern, start_line, end_line, seed = self.sonnet_task(line)
+        with instrument.timer('subsonnet'):
+            poem = Poem(pattern, self.forw_model, self.rev_model, start_line, end_line,
+                        executor=self.executor, seed=seed)
         return poem
 
-    def generate_full(self):
-        """Generate a full sonnet crown"""
-        #TODO: Parallelize this
-        if self.config.parallel_poems:
-            print('Hello')
-            p = Pool()
-            self.subsonnets = p.imap( self.generate_single_sonnet, range(self.line_number) )
-        else:
-            for i in range(self.line_number):
+    def generate_full(self, on_subsonnet=None):
+        """Generate a full sonnet crown. on_subsonnet(index, poem) is called as
+        soon as each subsonnet is finished, in completion order."""
+        for i, poem in self.iter_subsonnets():
+            if on_subsonnet is not None:
+                on_subsonnet(i, poem)
+
+    def iter_subsonnets(self):
+        """Yield (index, subsonnet) pairs as the missing subsonnets are finished,
+        in completion order. Each is also stored in self.subsonnets."""
+        missing = [i for i in range(self.line_number) if self.subsonnets[i] is None]
+        if self.config.parallel_poems and missing:
+            # Workers already hold the models, only descriptors are sent
+            tasks = [(i, self.sonnet_task(i)) for i in missing]
+            results = self.pool.imap_unordered(_indexed_sonnet_task, tasks)
+            try:
+                for _ in range(len(tasks)):
+                    i, poem, stats = results.next(self.config.pool_task_timeout)
+                    instrument.merge(stats)
+                    self.subsonnets[i] = poem
+                    yield i, poem
+            except TimeoutError as e:
+                # A hung pool, or one that lost a worker and with it a task,
+                # is not reused. Errors raised by a task, e.g. GenerationError,
+                # propagate: rerunning it serially with the same seed would
+                # only fail the same way.
+                instrument.count('pool_failures')
+                log.warning("Worker pool timed out, finishing the crown serially: %r", e)
+                close_pool(terminate=True)
+                self.pool = None
+
+        # Serial mode, or whatever the workers did not deliver
+        for i in missing:
+            if self.subsonnets[i] is None:
                 self.subsonnets[i] = self.generate_single_sonnet(i)
+                yield i, self.subsonnets[i]
+
+    def close(self):
+        """Shut down the worker pools used by this crown"""
+        if self.pool is not None:
+            close_pool()
+            self.pool = None
+        if self.executor is not None:
+            close_executor()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def print_full(self):
         """Print the full sonnet crown with subsonnets first and master last"""
-        print(self.subsonnets)
-
         for i in range(self.line_number):
             if self.subsonnets[i] == None:
                 print("\n-- Subsonnet missing --")
@@ -104,19 +414,63 @@ class Poem:
     """An auto-generated poem with lines based on the text corpus stated in the
     config file. A rhyme pattern argument can be passed for the constructor."""
 
-    def __init__(self, pattern='ABAB6767', fmodel=None, rmodel=None, *args):
+    def __init__(self, pattern='ABAB6767', fmodel=None, rmodel=None, *args, pool=None,
+                 executor=None, seed=None):
+        """With pattern None no poem is generated and the instance only serves
+        to build lines and groups. A worker pool from get_pool can be passed to
+        build rhyme groups in parallel, and an executor from get_executor to
+        race candidate rhyming lines.
+
+        With a seed every rhyme group and free line is built from its own
+        derived seed, so the poem is the same whether groups are built here
+        or in workers. Seeded poems skip the line reservoir and speculative
+        lines, whose results depend on timing, and bound their group search
+        by config.group_max_expansions instead of the group_time_budget
+        deadline.
+
+        A poem that makes more sentence attempts than its limit, see
+        attempt_limit, raises GenerationError rather than searching forever."""
         self.config = config.Config()
         self.forw_model = fmodel
         self.rev_model = rmodel
+        self.syllables = getattr(fmodel, 'syllables', None) or syllableCount.defaultCounter
+        self.seed = seed
+        self.attempts = 0
+        self.max_attempts = (_attempt_limit if _attempt_limit is not None
+                             else self.config.poem_max_attempts)
+        self.pool = pool
+        self.executor = executor if seed is None else None
+        self.reservoir = _process_reservoir(fmodel, rmodel) if seed is None else None
+        # The store belongs to the corpus of this process's models
+        self.store = None
+        if fmodel is not None and fmodel is _worker_models.get('forw'):
+            self.store = _worker_models.get('store')
 
         # Now generate the poem
-        self.poem = self.generate_poem(pattern, *args)
+        self.poem = None
+        if pattern is not None:
+            self.poem = self.generate_poem(pattern, *args)
+
+    def __getstate__(self):
+        # Models and pool stay in their process, only the poem travels
+        state = self.__dict__.copy()
+        for key in ('forw_model', 'rev_model', 'syllables', 'pool', 'executor', 'reservoir',
+                    'store'):
+            state[key] = None
+        return state
 
     def generate_poem(self, pattern, *args):
         """Generate a poem with a rhyme and syllable pattern as followed in the argument,
         e.g 'ABAB5757'. Upper and lower case letters are differentiated. For lines
         which should not necessarily rhyme, '_' should be passed, e.g. 'AA_BB55755'
         where there third line will not be part of a rhyme pattern."""
+        with instrument.timer('poem'):
+            return '\n'.join(self.iter_lines(pattern, *args))
+
+    def iter_lines(self, pattern, *args):
+        """Yield the lines of a poem with the pattern described in generate_poem,
+        in order, each as soon as it and all lines before it are finished. A
+        rhyme group is built as a whole, so its lines come out together."""
 
         #TODO: Allow better pattern with ABAB-5-7-5-7, counting non-digit chars and taking
         # half the number, then splitting with character - and ignoring first element
@@ -152,17 +506,21 @@ class Poem:
         non_rhymes = [l for l in lines if l['rhyme'] == '_']
         final_lines = []
 
-        # Build each group in parallel
-        if self.config.parallel_groups:
-            p = Pool()
-            #accidental_rhymes = 0
-            #while accidental_rhymes is not None:
-            if self.config.is_test:
-                for group in p.imap( self._build_group_TEST, line_pairings.values() ):
-                    final_lines += group
-            else:
-                for group in p.imap( self._build_group, line_pairings.values() ):
-                    final_lines += group
+        # Rhyme groups and non-rhyming lines, in the order of their first line
+        units = list(line_pairings.values()) + [[line] for line in non_rhymes]
+        units.sort(key=lambda unit: unit[0]['index'])
+
+        # Seeds of the units, the same for serial and parallel builds
+        seeds = [seeding.deriveSeed(self.seed, 'unit', n) for n in range(len(units))]
+
+        # Build each group in parallel, pool workers cannot start their own
+        built_groups = None
+        if self.config.parallel_groups and self.pool is not None and not current_process().daemon:
+            method = '_build_group_TEST' if self.config.is_test else '_build_group_reverse'
+            tasks = [(method, unit, seed) for unit, seed in zip(units, seeds)
+                     if unit[0]['rhyme'] != '_']
+            # Results come back in the order of units
+            built_groups = self.pool.imap( _group_task, tasks )
 
         #TODO: Implement smart rewriting of accidental rhyme lines. Legacy code:
                         # Rhyme found! Ensure that it is different from other groups
@@ -174,31 +532,37 @@ class Poem:
                         # if not already_used:
                         #     rhyme_attempts = 0
                         #     current += 1
-        else:
-            if self.config.is_test:
-                for group in line_pairings.values():
-                    final_lines += self._build_group_TEST(group)
-            else:
-                for group in line_pairings.values():
-                    # # Check for accidental rhymes
-                    # while True:
-                    new_group = self._build_group_reverse(group)
-                    #     for prev_sent in final_lines:
-                    #         if is_rhyme_pair(prev_sent['sent'], new_group[0]['sent']):
-                    #             print("Rhyme already used, trying something else.")
-                    #             already_used = True
-                    #     if not already_used:
-                    #         break
-                    final_lines += new_group
-
-
-        # Put whatever on the non-rhyming line
-        # TODO: make sure they don't accidentally rhyme with any rhyme pairs
-        for line in non_rhymes:
-            if line['sent'] == None:
-                line['sent'] = self._new_sentence(line['syls'])
+
+        finished = {}
+        next_index = 0
+        for unit, seed in zip(units, seeds):
+            seeding.seedRandom(seed)
+            if unit[0]['rhyme'] == '_':
+                # Put whatever on the non-rhyming line
+                # TODO: make sure they don't accidentally rhyme with any rhyme pairs
+                line = unit[0]
                 while line['sent'] == None:
                     line['sent'] = self._new_sentence(line['syls'])
+                new_lines = unit
+            elif built_groups is not None:
+                new_lines, stats = next(built_groups)
+                instrument.merge(stats)
+            elif self.config.is_test:
+                new_lines = self._build_group_TEST(unit)
+            else:
+                # Lines of the groups built so far and the fixed lines of
+                # the groups still to come
+                others = [line['sent'] for line in lines
+                          if line['sent'] is not None and line not in unit]
+                new_lines = self._build_group_reverse(unit, others)
+            final_lines += new_lines
+
+            # Hand out every line whose predecessors are all done
+            for line in new_lines:
+                finished[line['index']] = line['sent']
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
 
         # Run through final lines, check if any accidental rhymes
 
@@ -211,14 +575,6 @@ class Poem:
         # If fixed group, add the other one to accidental rhymes
 
         # If no accidental rhymes, exit
-            #accidental_rhymes = None
-
-        # Sort the rhymes into the desired structure
-
-        final_lines += non_rhymes
-        final_lines.sort(key=lambda x: x['index'])
-
-        return '\n'.join(line['sent'] for line in final_lines)
 
     def print_poem(self):
 
@@ -231,18 +587,33 @@ class Poem:
         #print('-' * length)
         #print('*' * length)
 
-    def _build_group_reverse(self,group):
+    def _build_group_reverse(self,group,others=()):
+        """Build a rhyme group from the reverse model. `others` are the lines
+        of other groups known so far, which speculative candidates must not
+        rhyme with and store lines must not repeat."""
         self.config = config.Config()
         max_tries_per_sent = self.config.max_rhyme_attempts
         n_lines = len(group)
 
-        print('Looking for rhymes for ' + group[0]['rhyme'] + ' group.')
-
+        # Checked once, the loop below logs every attempt
+        debug = log.isEnabledFor(logging.DEBUG)
+        log.debug('Looking for rhymes for %s group.', group[0]['rhyme'])
+
+        # A fixed line whose rhyme class has no other start state in the
+        # reverse corpus is matched with near rhymes (chooseRhymingWord). With
+        # none either only forward lines are left; crowns avoid such master
+        # lines, so this is for lines passed in by hand.
+        fixed_sent = group[0]['sent'] or group[n_lines-1]['sent']
+        if fixed_sent is not None and not self.rev_model.canRhyme(fixed_sent.split()[-1]):
+            log.warning("No rhymes in corpus for fixed line %r, matching forward lines instead",
+                        fixed_sent)
+            return self._build_group(group, others)
+
+        instrument.count('groups')
         if group[0]['sent'] is not None:
             # Allow no resets
             sent_fixed = 1
-            print("First line fixed")
-            print(group[0]['sent'])
+            log.debug("First line fixed")
         elif group[n_lines-1]['sent'] is not None:
             # Allow no resets, remember that it was the last line
             sent_fixed = 2
@@ -250,24 +621,52 @@ class Poem:
             hold = group[0]
             group[0] = group[n_lines-1]
             group[n_lines-1] = hold
-            print("Last line fixed")
-            print(group[0]['sent'])
+            log.debug("Last line fixed")
         else:
             # Create first sentence in the group
             sent_fixed = False
-            group[0]['sent'] = self._new_sentence(group[0]['syls'])
-            while group[0]['sent'] == None:
-                group[0]['sent'] = self._new_sentence(group[0]['syls'])
+            group[0]['sent'] = self._new_anchor_sentence(
+                group[0]['syls'], [line['syls'] for line in group[1:]], others)
 
-        print(group[0]['sent'])
+        log.debug('Anchor line: %s', group[0]['sent'])
 
         rhymeWord = group[0]['sent'].split()[-1]
         # Track how many lines we've finished
         current = 1
 
+        if self.reservoir is not None and self._group_from_reservoir(group):
+            instrument.count('reservoir_groups')
+            current = n_lines
+        elif self.store is not None and self._group_from_store(group, others):
+            instrument.count('store_groups')
+            current = n_lines
+
+        if self.config.group_search and current < n_lines:
+            # Decode the rest of the group jointly, fall back to line by line.
+            # A deadline would make seeded poems depend on the machine's speed.
+            seeded = self.seed is not None
+            with instrument.timer('group_search'):
+                lines = groupSearch.searchGroup(
+                    self.rev_model,
+                    group[0]['sent'],
+                    [line['syls'] for line in group[1:]],
+                    beam_width=self.config.group_beam_width,
+                    time_budget=None if seeded else self.config.group_time_budget,
+                    max_expansions=self.config.group_max_expansions if seeded else None,
+                    max_steps=self.config.syllable_walk_max_steps,
+                    max_overlap_ratio=self.config.markovify_max_overlap_ratio,
+                    max_overlap_total=self.config.markovify_max_overlap_total
+                )
+            if lines is not None:
+                instrument.count('group_search_hits')
+                for line, sent in zip(group[1:], lines):
+                    line['sent'] = sent
+                current = n_lines
+            else:
+                instrument.count('group_search_misses')
+
         # Prepare iteration to find rhymes
         rhyme_attempts = 0
-        n_animation_dots = 0
 
         # INFINITE LOOP WOOO LET'S GO
         while True:
@@ -275,33 +674,42 @@ class Poem:
                 # If we have all the rhymes needed, move on to the next rhyme group
                 break
 
-            if rhyme_attempts % int(max_tries_per_sent/10) == 0:
-                #print('\r' + str(rhyme_attempts) )
-                # Fancy animation
-                n_animation_dots += 1
-                print('\r' + n_animation_dots * '.', end='')
-                if n_animation_dots == 20:
-                    n_animation_dots = 0
-
             rhyme_attempts += 1
-            print('1')
             if rhyme_attempts > max_tries_per_sent and not sent_fixed:
-                print("\nTried more than max times, restarting group\n")
+                log.info("Tried more than max times, restarting group")
+                instrument.count('group_restarts')
                 # Restart from first sentence in group
-                group[0]['sent'] = self._new_sentence(group[0]['syls'])
-                while group[0]['sent'] == None:
-                    group[0]['sent'] = self._new_sentence(group[0]['syls'])
+                group[0]['sent'] = self._new_anchor_sentence(
+                    group[0]['syls'], [line['syls'] for line in group[1:]], others)
+                rhymeWord = group[0]['sent'].split()[-1]
                 current = 1
                 rhyme_attempts = 0
 
             # Generate next line
-            print('2')
+            if self._can_speculate():
+                # Race candidates across processes, a failed round counts as
+                # one attempt per candidate. Fixed groups cannot restart, so
+                # they settle for any line once the attempts are used up.
+                self._spend_attempts(self.config.speculative_lines)
+                sent = self._speculative_rhyming_sentence(
+                    group[current]['syls'], rhymeWord,
+                    [line['sent'] for line in group[:current]], others,
+                    strict=rhyme_attempts <= max_tries_per_sent)
+                if sent is None:
+                    instrument.count('speculative_misses')
+                    rhyme_attempts += self.config.speculative_lines - 1
+                    continue
+                group[current]['sent'] = sent
+                current += 1
+                continue
+
             group[current]['sent'] = self._new_rhyming_sentence(group[current]['syls'],rhymeWord)
-            print(group[current]['sent'])
             while group[current]['sent'] == None:
                 # Keep trying until you get actual sentence
                 group[current]['sent'] = self._new_rhyming_sentence(group[current]['syls'],rhymeWord)
-                print(group[current]['sent'])
+            if debug:
+                log.debug('Line %d after %d attempts: %s', current, rhyme_attempts,
+                          group[current]['sent'])
 
             current += 1
 
@@ -310,8 +718,6 @@ class Poem:
                 #print("Rhyme found!")
                 #current += 1
 
-        print()  # animation on new line
-
         if sent_fixed == 2:
             # Switch the lines back
             hold = group[0]
@@ -320,12 +726,114 @@ class Poem:
 
         return group
 
-    def _build_group(self,group):
+    def _spend_attempts(self, n=1):
+        """Count sentence attempts against the poem's limit"""
+        self.attempts += n
+        if self.max_attempts is not None and self.attempts > self.max_attempts:
+            raise GenerationError('No poem after %d sentence attempts' % self.max_attempts)
+
+    def _can_speculate(self):
+        # Daemonic pool workers cannot start processes of their own
+        return (self.executor is not None and self.config.speculative_lines > 0
+                and not current_process().daemon)
+
+    def _speculative_rhyming_sentence(self, syls, word, group_lines, others, strict=True):
+        """Generate `speculative_lines` candidate rhyming lines concurrently and
+        return the first valid one, cancelling the rest. A valid line ends on a
+        rhyme word not yet used in the group and does not accidentally rhyme
+        with lines of other groups. None if no candidate was valid."""
+        used = set(line.split()[-1].lower() for line in group_lines if line)
+        futures = set(self.executor.submit(_line_task, (syls, word, random.getrandbits(32)))
+                      for _ in range(self.config.speculative_lines))
+        found = None
+        try:
+            while futures and found is None:
+                done, futures = wait(futures, timeout=self.config.speculative_timeout,
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    sent, stats = future.result()
+                    instrument.merge(stats)
+                    if not sent:
+                        continue
+                    if not strict or self._is_valid_candidate(sent, used, others):
+                        found = sent
+                        break
+                    instrument.count('rhyme_rejections')
+        finally:
+            # Queued candidates are dropped, running ones are bounded by max_steps
+            for future in futures:
+                future.cancel()
+        return found
+
+    def _is_valid_candidate(self, sent, used, others):
+        if sent.split()[-1].lower() in used:
+            return False
+        return not any(is_rhyme_pair(other, sent) for other in others if other)
+
+    def _group_from_reservoir(self, group):
+        """Fill the lines after the anchor from the line reservoir. Either all
+        of them are filled and True returned, or the taken lines are put back."""
+        used = [group[0]['sent'].split()[-1].lower()]
+        taken = []
+        for line in group[1:]:
+            sent = self.reservoir.takeRhyming(int(line['syls']), group[0]['sent'].split()[-1], used)
+            if sent is None:
+                for syls, sent in taken:
+                    self.reservoir.put(sent, syls)
+                return False
+            used.append(sent.split()[-1].lower())
+            taken.append((int(line['syls']), sent))
+        for line, (syls, sent) in zip(group[1:], taken):
+            line['sent'] = sent
+        return True
+
+    def _group_from_store(self, group, others=()):
+        """Fill the lines after the anchor from the sentence store, True if
+        all of them were found. Lines ending on the last word of one of
+        `others`, the lines of other groups, are not taken."""
+        lines = self.store.findGroup(group[0]['sent'], [line['syls'] for line in group[1:]],
+                                     _last_words(others))
+        if lines is None:
+            return False
+        for line, sent in zip(group[1:], lines):
+            line['sent'] = sent
+        return True
+
+    def _new_anchor_sentence(self,syls,partners=(),others=()):
+        """Create the first sentence of a rhyme group, only accepting sentences
+        whose last word has rhyming start states in the reverse model. With a
+        line reservoir, prefer a line whose rhyme class has lines of the
+        partners' syllable counts in store. A line from the sentence store
+        does not rhyme with `others`, the lines of other groups."""
+
+        if self.reservoir is not None:
+            sent = self.reservoir.takeAnchor(int(syls), [int(s) for s in partners])
+            if sent is not None and self.rev_model.hasRhymes(sent.split()[-1]):
+                instrument.count('reservoir_lines')
+                return sent
+
+        if self.store is not None:
+            sent = self.store.anchorLine(syls, partners, exclude=_last_words(others))
+            if sent is not None and self.rev_model.hasRhymes(sent.split()[-1]):
+                return sent
+
+        sent = self._new_sentence(syls)
+        while sent == None or not self.rev_model.hasRhymes(sent.split()[-1]):
+            if sent is not None:
+                # No rhyming start state, so nothing could be found to rhyme
+                instrument.count('anchor_rejections')
+            sent = self._new_sentence(syls)
+        return sent
+
+    def _build_group(self,group,others=()):
         self.config = config.Config()
         max_tries_per_sent = self.config.max_rhyme_attempts
         n_lines = len(group)
 
-        print('Looking for rhymes for ' + group[0]['rhyme'] + ' group.')
+        log.debug('Looking for rhymes for %s group.', group[0]['rhyme'])
+        instrument.count('groups')
 
         if group[0]['sent'] is not None:
             # Allow no resets
@@ -340,16 +848,22 @@ class Poem:
         else:
             # Create first sentence in the group
             sent_fixed = False
-            group[0]['sent'] = self._new_sentence(group[0]['syls'])
+            if self.store is not None:
+                group[0]['sent'] = self.store.anchorLine(
+                    group[0]['syls'], [line['syls'] for line in group[1:]],
+                    exclude=_last_words(others))
             while group[0]['sent'] == None:
                 group[0]['sent'] = self._new_sentence(group[0]['syls'])
 
         # Track how many lines we've finished
         current = 1
 
+        # Look the rest of the group up before searching for it
+        if self.store is not None and self._group_from_store(group, others):
+            current = n_lines
+
         # Prepare iteration to find rhymes
         rhyme_attempts = 0
-        n_animation_dots = 0
 
         # INFINITE LOOP WOOO LET'S GO
         while True:
@@ -357,17 +871,10 @@ class Poem:
                 # If we have all the rhymes needed, move on to the next rhyme group
                 break
 
-            if rhyme_attempts % int(max_tries_per_sent/10) == 0:
-                #print('\r' + str(rhyme_attempts) )
-                # Fancy animation
-                n_animation_dots += 1
-                print('\r' + n_animation_dots * '.', end='')
-                if n_animation_dots == 20:
-                    n_animation_dots = 0
-
             rhyme_attempts += 1
             if rhyme_attempts > max_tries_per_sent and not sent_fixed:
-                print("\nTried more than max times, restarting group\n")
+                log.info("Tried more than max times, restarting group")
+                instrument.count('group_restarts')
                 # Restart from first sentence in group
                 group[0]['sent'] = self._new_sentence(group[0]['syls'])
                 while group[0]['sent'] == None:
@@ -383,10 +890,10 @@ class Poem:
 
             # Flexibly check if the line rhymes
             if is_rhyme_pair(group[0]['sent'], group[current]['sent']):
-                print("Rhyme found!")
+                log.debug("Rhyme found!")
                 current += 1
-
-        print()  # animation on new line
+            else:
+                instrument.count('rhyme_rejections')
 
         if sent_fixed == 2:
             # Switch the lines back
@@ -404,7 +911,7 @@ class Poem:
         max_tries_per_sent = self.config.max_rhyme_attempts
         n_lines = len(group)
 
-        print('Looking for rhymes for ' + group[0]['rhyme'] + ' group.')
+        log.debug('Looking for rhymes for %s group.', group[0]['rhyme'])
 
         if group[0]['sent'] is not None:
             # Allow no resets
@@ -426,7 +933,6 @@ class Poem:
 
         # Prepare iteration to find rhymes
         rhyme_attempts = 0
-        n_animation_dots = 0
 
         # INFINITE LOOP WOOO LET'S GO
         while True:
@@ -434,17 +940,9 @@ class Poem:
                 # If we have all the rhymes needed, move on to the next rhyme group
                 break
 
-            if rhyme_attempts % int(max_tries_per_sent/10) == 0:
-                #print('\r' + str(rhyme_attempts) )
-                # Fancy animation
-                n_animation_dots += 1
-                print('\r' + n_animation_dots * '.', end='')
-                if n_animation_dots == 20:
-                    n_animation_dots = 0
-
             rhyme_attempts += 1
             if rhyme_attempts > max_tries_per_sent and not sent_fixed:
-                print("\nTried more than max times, restarting group\n")
+                log.info("Tried more than max times, restarting group")
                 # Restart from first sentence in group
                 group[0]['sent'] = self._new_sentence(group[0]['syls'])
                 while group[0]['sent'] == None:
@@ -457,11 +955,9 @@ class Poem:
 
             # Flexibly check if the line rhymes
             if is_rhyme_pair(group[0]['sent'], group[current]['sent']):
-                print("Rhyme found!")
+                log.debug("Rhyme found!")
                 current += 1
 
-        print()  # animation on new line
-
         if sent_fixed == 2:
             # Switch the lines back
             hold = group[0]
@@ -475,37 +971,48 @@ class Poem:
         return type None if this fails."""
 
         syls = int(syls)
-        sent = self.rev_model.make_short_sentence(
-            syls * self.config.poem_avg_char_per_syl,
-            word,
-            0,
-            tries=100,
-            max_overlap_ratio=self.config.markovify_max_overlap_ratio,
-            max_overlap_total=self.config.markovify_max_overlap_total
-        )
+        if self.reservoir is not None:
+            sent = self.reservoir.takeRhyming(syls, word)
+            if sent is not None:
+                instrument.count('reservoir_lines')
+                return sent
+
+        instrument.count('sentence_attempts')
+        self._spend_attempts()
+        with instrument.timer('reverse_model'):
+            if self.config.syllable_walk:
+                sent = self.rev_model.make_syllable_sentence(
+                    syls,
+                    word,
+                    max_steps=self.config.syllable_walk_max_steps,
+                    max_overlap_ratio=self.config.markovify_max_overlap_ratio,
+                    max_overlap_total=self.config.markovify_max_overlap_total
+                )
+            else:
+                sent = self.rev_model.make_short_sentence(
+                    syls * self.config.poem_avg_char_per_syl,
+                    word,
+                    0,
+                    tries=100,
+                    max_overlap_ratio=self.config.markovify_max_overlap_ratio,
+                    max_overlap_total=self.config.markovify_max_overlap_total
+                )
 
         if sent == None:
+            instrument.count('walk_failures')
             return None
 
-        sent = gr.formatReverseSentence(sent)
-        print(sent)
+        sent = gr.formatReverseSentence(sent, self.rev_model.line_reversed)
         sent = ''.join(c for c in sent if c not in string.punctuation)
-        print(sent)
 
-        try:
-            #phones = [pnc.phones_for_word(p)[0] for p in sentNoPunctuation.split()]
-            phones = [pnc.phones_for_word(p)[0] for p in sent.split()]
-        except IndexError:
-            # Word not found in dictionary
-            print('Word not found in dictionary')
-            phones = []
-
-        print(phones)
-        print(sum([pnc.syllable_count(p) for p in phones]))
-        print(syls)
-        print("-*-")
-
-        if sum([pnc.syllable_count(p) for p in phones]) != syls or not sent:
+        sent_syls = self.syllables.countLine(sent)
+        if sent_syls is None:
+            instrument.count('dictionary_misses')
+
+        if sent_syls != syls or not sent:
+            instrument.count('syllable_rejections')
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('Rejected %r: %s syllables, wanted %d', sent, sent_syls, syls)
             return None
         else:
             return sent #''.join(c for c in sent if c not in string.punctuation)
@@ -515,122 +1022,80 @@ class Poem:
         return type None if this fails."""
 
         syls = int(syls)
-        sent = self.forw_model.make_short_sentence(
-            syls * self.config.poem_avg_char_per_syl,
-            tries=100,
-            max_overlap_ratio=self.config.markovify_max_overlap_ratio,
-            max_overlap_total=self.config.markovify_max_overlap_total
-        )
+        if self.reservoir is not None:
+            sent = self.reservoir.take(syls)
+            if sent is not None:
+                instrument.count('reservoir_lines')
+                return sent
+
+        instrument.count('sentence_attempts')
+        self._spend_attempts()
+        with instrument.timer('forward_model'):
+            if self.config.syllable_walk:
+                sent = self.forw_model.make_syllable_sentence(
+                    syls,
+                    max_steps=self.config.syllable_walk_max_steps,
+                    max_overlap_ratio=self.config.markovify_max_overlap_ratio,
+                    max_overlap_total=self.config.markovify_max_overlap_total
+                )
+            else:
+                sent = self.forw_model.make_short_sentence(
+                    syls * self.config.poem_avg_char_per_syl,
+                    tries=100,
+                    max_overlap_ratio=self.config.markovify_max_overlap_ratio,
+                    max_overlap_total=self.config.markovify_max_overlap_total
+                )
 
         if sent == None:
+            instrument.count('walk_failures')
             return None
 
-        # Might be double work checking for punctuation
-        sentNoPunctuation = sent[0:-1]
-        try:
-            phones = [pnc.phones_for_word(p)[0] for p in sentNoPunctuation.split()]
-        except IndexError:
-            # Word not found in dictionary
-            phones = []
+        sent_syls = self.syllables.countLine(sent)
+        if sent_syls is None:
+            instrument.count('dictionary_misses')
 
-        if sum([pnc.syllable_count(p) for p in phones]) != syls or not sent:
+        if sent_syls != syls or not sent:
+            instrument.count('syllable_rejections')
             return None
         else:
             return ''.join(c for c in sent if c not in string.punctuation)
 
-def rhyme_degree(target_word, test_word):
-    """Returns a number between 0 and 1 as the degree of rhyming between two
-    words, with 1 being an exact rhyme and 0 being no similarity at all."""
-
-    if test_word in pnc.rhymes(target_word):
-        print('\rFound rhyme pair from the pronouncing library:')
-        print(target_word, 'and', test_word)
+def main(argv=None):
+    """Generate and print a crown of sonnets"""
+    cfg = config.Config()
+    parser = argparse.ArgumentParser(description='Generate a crown of sonnets.')
+    parser.add_argument('pattern', nargs='?', default=DEFAULT_PATTERN,
+                        help='rhyme and syllable pattern of the master sonnet (default %s)'
+                        % DEFAULT_PATTERN)
+    parser.add_argument('-f', '--file', default=DEFAULT_FILE, help='corpus file or directory')
+    parser.add_argument('-s', '--seed', type=int, default=cfg.seed,
+                        help='seed for a reproducible crown')
+    parser.add_argument('--report', default=cfg.instrument_report,
+                        help='write counters and timers of the run to this JSON file')
+    parser.add_argument('--profile', default=cfg.profile_path,
+                        help='profile the run with cProfile, dumping the stats here')
+    parser.add_argument('--log-level', help='DEBUG, INFO, WARNING, ... (config.log_level by default)')
+    args = parser.parse_args(argv)
+    logSetup.configureLogging(args.log_level)
+
+    #poem = Poem('ABABCDCDEFEGFG76767676767676')
+    #poem.print_poem()
+    try:
+        with instrument.profiled(args.profile):
+            sonnet_crown = Sonnet_crown(args.pattern, fFile=args.file, seed=args.seed)
+            #sonnet_crown.generate_single_sonnet(0)
+            sonnet_crown.generate_full()
+    except GenerationError as e:
+        # Only with config.poem_max_attempts set
+        log.error('%s', e)
+        close_pool(terminate=True)
+        close_executor()
         return 1
-
-    # extract word part from last stressed syllable excluding that syll's onset
-    rhymes = {target_word: None, test_word: None}
-    for word in rhymes:
-        try:
-            # get pronounciation for word
-            pron = pnc.phones_for_word(word)[0]
-        except IndexError:  # in case one of the words is not in the dictionary
-            return 0
-        # get stress pattern and find last stressed syllables
-        stress = pnc.stresses(pron)
-        last_stress = max([stress.rfind('1'), stress.rfind('2')])
-        try:
-            sylls = ARPA.syllabifyARPA(pron, return_list=True)
-        except ValueError:  # in case the word cannot be syllabified
-            return 0
-        sylls = sylls[last_stress:]
-        first_onset = re.split(ARPA.VOWELS_REGEX, sylls[0])[0]
-        sylls[0] = sylls[0].replace(first_onset, '', 1)
-        rhymes[word] = sylls
-
-    # test for matching vowels and consonant clusters in onset and coda
-    # the stressed vowel weighs double
-    phones = 1 + max([sum(len(syll.split()) for syll in rhyme)
-                      for rhyme in rhymes.values()])
-    matches = 0
-    for target_syll, test_syll in zip(rhymes[target_word], rhymes[test_word]):
-        target_vowel = [phone for phone in target_syll.split()
-                        if re.match(ARPA.VOWELS_REGEX, phone)][0]
-        test_vowel = [phone for phone in test_syll.split()
-                      if re.match(ARPA.VOWELS_REGEX, phone)][0]
-        target_clusters = target_syll.split(target_vowel)
-        test_clusters = test_syll.split(test_vowel)
-        # measure match of syllable onsets
-        matches += len(
-            set(target_clusters[0].strip().split()).intersection(
-                set(test_clusters[0].strip().split())
-            )
-        )
-        # measure match of vowels
-        if target_vowel[:2] == test_vowel[:2]:  # test for the vowel itself
-            matches += 1
-            # test for similar stress
-            if (target_vowel[-1] in ['1', '2']
-                    and target_vowel[-1] == test_vowel[-1]):
-                matches += 1
-        # measure match of syllable codas
-        matches += len(
-            set(target_clusters[1].strip().split()).intersection(
-                set(test_clusters[1].strip().split())
-            )
-        )
-    degree = matches / phones
-    if degree > 0.7:
-        print('\rFound rhyme pair with a rhyming degree of: ', degree)
-        print(rhymes)
-    return degree
-
-def is_rhyme_pair(target_line, test_line, same_allowed=False, min_degree=0.8):
-    """Return true if the passed lines rhyme."""
-
-    # avoid later problems from empty or None lines
-    if (not target_line or target_line == ''
-            or not test_line or test_line == ''):
-        return False
-
-    # get the last words from the lines
-    target_last = target_line.split()[-1]
-    test_last = test_line.split()[-1]
-
-    if target_last.lower() == test_last.lower() and not same_allowed:
-        return False
-
-    # TODO: take short words into account: combine short words and see if they
-    # can constitute one phonological word, i.e. one stress unit
-    degree = rhyme_degree(target_last, test_last)
-    if degree > min_degree:
-        return True
-    else:
-        return False
-
-#poem = Poem('ABABCDCDEFEGFG76767676767676')
-#poem.print_poem()
-sonnet_crown = Sonnet_crown('ABCB7676')
-#sonnet_crown.generate_single_sonnet(0)
-sonnet_crown.generate_full()
-#sonnet_crown.subsonnets[1] = sonnet_crown.generate_single_sonnet(1)
-sonnet_crown.print_full()
+    sonnet_crown.print_full()
+    sonnet_crown.close()
+    if args.report:
+        instrument.writeReport(args.report, pattern=args.pattern, seed=args.seed)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,83 @@
-import nltk
+import config
+import marshal
+import os
+import sys
 
-def generateRhymes(input, order):
-    pronunDict = dict(nltk.corpus.cmudict.entries()) # CMU Pronunciation Dictionary, contains phonemes used to match rhyming words
-    rhymeList = []
+# Rhyme indexes are built once per process on first use. Call loadIndex()
+# before creating a Pool so forked workers share them instead of rebuilding.
+# The pronunciation dictionary is kept in the model cache as a marshal dump,
+# which loads many times faster than nltk parses CMUdict; nltk itself is
+# only imported to build it.
+DICT_CACHE_NAME = 'cmudict-v1.marshal'
 
-    inputSyllables = pronunDict.get(input)
+_pronunDict = None
+_suffixIndex = {}
+_rhymePartIndex = None
 
-    if inputSyllables:
-        rhymeList += [word for word, pronun in pronunDict.items() if pronun[-order:] == inputSyllables[-order:] and word != input]
-        return rhymeList
+def pronunciationDict():
+    """CMU Pronunciation Dictionary as a word -> phoneme list dict, contains
+    phonemes used to match rhyming words"""
+    global _pronunDict
+    if _pronunDict is None:
+        path = os.path.join(config.Config().model_cache_dir, DICT_CACHE_NAME)
+        try:
+            with open(path, 'rb') as f:
+                # Reading the file first is much faster than marshal.load
+                _pronunDict = marshal.loads(f.read())
+        except (OSError, ValueError, EOFError, TypeError):
+            import nltk.corpus
+            # Interned phonemes are dumped once and shared by all entries
+            _pronunDict = {word: [sys.intern(phone) for phone in pronun]
+                           for word, pronun in nltk.corpus.cmudict.entries()}
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                marshal.dump(_pronunDict, f)
+            os.replace(tmp, path)
+    return _pronunDict
+
+def suffixIndex(order):
+    """Index of all words keyed by the tuple of their last `order` phonemes"""
+    if order not in _suffixIndex:
+        index = {}
+        for word, pronun in pronunciationDict().items():
+            index.setdefault(tuple(pronun[-order:]), []).append(word)
+        _suffixIndex[order] = index
+    return _suffixIndex[order]
+
+def rhymingPart(pronun):
+    """Phonemes from the last stressed vowel to the end of the word"""
+    for i in range(len(pronun) - 1, 0, -1):
+        if pronun[i][-1] in '12':
+            return tuple(pronun[i:])
+    return tuple(pronun)
+
+def rhymePartIndex():
+    """Index of all words keyed by their rhyming part, see rhymingPart"""
+    global _rhymePartIndex
+    if _rhymePartIndex is None:
+        index = {}
+        for word, pronun in pronunciationDict().items():
+            index.setdefault(rhymingPart(pronun), []).append(word)
+        _rhymePartIndex = index
+    return _rhymePartIndex
 
+def loadIndex(orders=(2,)):
+    """Build the rhyme indexes up front, e.g. before forking workers"""
+    for order in orders:
+        suffixIndex(order)
+    rhymePartIndex()
 
+def generateRhymes(input, order):
+    inputSyllables = pronunciationDict().get(input)
+
+    if inputSyllables:
+        rhymeList = suffixIndex(order)[tuple(inputSyllables[-order:])]
+        return [word for word in rhymeList if word != input]
 
+def generateRhymesByPart(input):
+    inputSyllables = pronunciationDict().get(input)
+
+    if inputSyllables:
+        rhymeList = rhymePartIndex()[rhymingPart(inputSyllables)]
+        return [word for word in rhymeList if word != input]
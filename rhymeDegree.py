@@ -0,0 +1,132 @@
+import functools
+import logging
+import syllabifyARPA as ARPA
+
+# Degree of rhyming between words, shared by the poem generators.
+#
+# Both the decomposed rhyme tail of every word and the degree of every word
+# pair are cached, so the repeated comparisons in the generators' retry loops
+# cost a dict lookup. cache_info() reports hits and misses of each cache.
+
+PAIR_CACHE_SIZE = 1 << 16
+WORD_CACHE_SIZE = 1 << 15
+
+log = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def rhyming_parts(word):
+    """Rhyming parts of all pronunciations of a word, as used by pnc.rhymes"""
+    import pronouncing as pnc
+    return frozenset(pnc.rhyming_part(pron) for pron in pnc.phones_for_word(word))
+
+def is_pronouncing_rhyme(target_word, test_word):
+    """Same as `test_word in pnc.rhymes(target_word)`, without building the
+    full rhyme list"""
+    # pnc.rhymes only returns dictionary words, which are lower case
+    if test_word == target_word or test_word != test_word.lower():
+        return False
+    return not rhyming_parts(target_word).isdisjoint(rhyming_parts(test_word))
+
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def rhyme_tail(word):
+    """Syllables of a word from its last stressed syllable on, excluding that
+    syllable's onset, as (onset phones, vowel, coda phones, phone count)
+    tuples. None if the word is not in the dictionary or cannot be
+    syllabified."""
+    import pronouncing as pnc
+    try:
+        # get pronounciation for word
+        pron = pnc.phones_for_word(word)[0]
+    except IndexError:  # in case the word is not in the dictionary
+        return None
+    # get stress pattern and find last stressed syllables
+    stress = pnc.stresses(pron)
+    last_stress = max([stress.rfind('1'), stress.rfind('2')])
+    try:
+        sylls = ARPA.syllabify(pron)
+    except ValueError:  # in case the word cannot be syllabified
+        return None
+
+    tail = []
+    for i, syll in enumerate(sylls[last_stress:]):
+        phones = syll.split()
+        v = [j for j, phone in enumerate(phones) if ARPA.isVowel(phone)][0]
+        # the first syllable's onset is not part of the rhyme
+        onset = phones[:v] if i else []
+        tail.append((frozenset(onset), phones[v], frozenset(phones[v+1:]),
+                     len(onset) + len(phones) - v))
+    return tuple(tail)
+
+@functools.lru_cache(maxsize=PAIR_CACHE_SIZE)
+def pair_degree(target_word, test_word):
+    """Cached (degree, tails) for a word pair, tails is None for pronouncing
+    library rhymes"""
+    if is_pronouncing_rhyme(target_word, test_word):
+        return 1, None
+
+    tails = (rhyme_tail(target_word), rhyme_tail(test_word))
+    if None in tails:
+        return 0, None
+    target_tail, test_tail = tails
+
+    # test for matching vowels and consonant clusters in onset and coda
+    # the stressed vowel weighs double
+    phones = 1 + max(sum(syll[3] for syll in tail) for tail in tails)
+    matches = 0
+    for target_syll, test_syll in zip(target_tail, test_tail):
+        target_onset, target_vowel, target_coda, _ = target_syll
+        test_onset, test_vowel, test_coda, _ = test_syll
+        # measure match of syllable onsets
+        matches += len(target_onset & test_onset)
+        # measure match of vowels
+        if target_vowel[:2] == test_vowel[:2]:  # test for the vowel itself
+            matches += 1
+            # test for similar stress
+            if (target_vowel[-1] in ['1', '2']
+                    and target_vowel[-1] == test_vowel[-1]):
+                matches += 1
+        # measure match of syllable codas
+        matches += len(target_coda & test_coda)
+    return matches / phones, tails
+
+def rhyme_degree(target_word, test_word):
+    """Returns a number between 0 and 1 as the degree of rhyming between two
+    words, with 1 being an exact rhyme and 0 being no similarity at all."""
+
+    degree, tails = pair_degree(target_word, test_word)
+    if log.isEnabledFor(logging.DEBUG):
+        if degree == 1 and tails is None:
+            log.debug('Found rhyme pair from the pronouncing library: %s and %s',
+                      target_word, test_word)
+        elif degree > 0.7:
+            log.debug('Found rhyme pair with a rhyming degree of %s: %s', degree,
+                      {target_word: tails[0], test_word: tails[1]})
+    return degree
+
+def is_rhyme_pair(target_line, test_line, same_allowed=False, min_degree=0.8):
+    """Return true if the passed lines rhyme."""
+
+    # avoid later problems from empty or None lines
+    if (not target_line or target_line == ''
+            or not test_line or test_line == ''):
+        return False
+
+    # get the last words from the lines
+    target_last = target_line.split()[-1]
+    test_last = test_line.split()[-1]
+
+    if target_last.lower() == test_last.lower() and not same_allowed:
+        return False
+
+    # TODO: take short words into account: combine short words and see if they
+    # can constitute one phonological word, i.e. one stress unit
+    degree = rhyme_degree(target_last, test_last)
+    if degree > min_degree:
+        return True
+    else:
+        return False
+
+def cache_info():
+    """Hit and miss counters of the rhyme caches"""
+    return {name: cache.cache_info()._asdict() for name, cache in [
+        ('pairs', pair_degree), ('tails', rhyme_tail), ('parts', rhyming_parts)]}
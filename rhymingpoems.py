@@ -3,9 +3,10 @@ import os
 import markovify
 import config
 import string
-import syllabifyARPA as ARPA
-import re
-from multiprocessing import Pool
+from rhymeDegree import is_rhyme_pair
+import modelCache
+import sentenceStore
+import syllableCount
 
 #Strategy: Create one master sonnet. Then create all 14 other sonnets.
 #TODO: ALlow poem generator to have predefined first and last lines
@@ -40,14 +41,18 @@ class Poem:
         self.config = config.Config()
         max_rhyme_attempts = self.config.max_rhyme_attempts
 
-        all_text = ''
-        for file in os.listdir(self.config.markovify_input_dir):
-            if os.path.isdir(file):  # skip folders
-                continue
-            with open(self.config.markovify_input_dir + file,
-                      encoding='utf-8') as f:
-                all_text += f.read()
-        self.text_model = markovify.Text(all_text)
+        paths = [self.config.markovify_input_dir + file
+                 for file in os.listdir(self.config.markovify_input_dir)]
+        # skip folders
+        paths = [path for path in paths if not os.path.isdir(path)]
+        self.text_model = modelCache.loadModel(markovify.Text, paths)
+        # Clauses of the reversed corpora would be read backwards. Without
+        # walking models the store only holds corpus clauses, if enabled.
+        self.store = None
+        if self.config.sentence_store:
+            self.store = sentenceStore.loadStore([path for path in paths
+                                                  if not path.endswith('_reverse.txt')],
+                                                 corpus_lines=self.config.sentence_store_corpus_lines)
         #self.first_line = argv[0]
         #self.last_line = argv[1]
         # Now pass to the poem
@@ -82,6 +87,13 @@ class Poem:
         # Find rhymes for each group. Rhyme is letter (A), group is the object
         for rhyme, group in zip(line_pairings, line_pairings.values()):
             print('Looking for rhymes for ' + rhyme + ' group.')
+
+            # Look the whole group up in the sentence store first
+            if self.store is not None and self._group_from_store(group, final_lines):
+                print(group[0]['sent'])
+                final_lines += group
+                continue
+
             # Create first sentence in the group
 
             group[0]['sent'] = self._new_sentence(group[0]['syls'])
@@ -156,6 +168,22 @@ class Poem:
 
         return '\n'.join(line['sent'] for line in final_lines)
 
+    def _group_from_store(self, group, final_lines):
+        """Fill a group from the sentence store, True if it was filled with
+        lines that do not rhyme with earlier groups"""
+        anchor = self.store.anchorLine(group[0]['syls'], [l['syls'] for l in group[1:]])
+        if anchor is None:
+            return False
+        lines = self.store.findGroup(anchor, [l['syls'] for l in group[1:]])
+        if lines is None:
+            return False
+        if any(is_rhyme_pair(prev_sent['sent'], anchor) for prev_sent in final_lines):
+            print("Rhyme already used, trying something else.")
+            return False
+        for line, sent in zip(group, [anchor] + lines):
+            line['sent'] = sent
+        return True
+
     def print_poem(self):
 
         length = max(len(line) for line in self.poem.split('\n'))
@@ -171,8 +199,6 @@ class Poem:
         sent = None
         phones = []
         while sent == None or sum([pnc.syllable_count(p) for p in phones]) != syls:
-            print(sent)
-            print(sum([pnc.syllable_count(p) for p in phones])-syls)
             sent = self.text_model.make_short_sentence(
                 syls * self.config.poem_avg_char_per_syl,
                 tries=100,
@@ -203,110 +229,11 @@ class Poem:
         if sent == None:
             return None
 
-        # Might be double work checking for punctuation
-        sentNoPunctuation = sent[0:-1]
-        try:
-            phones = [pnc.phones_for_word(p)[0] for p in sentNoPunctuation.split()]
-        except IndexError:
-            # Word not found in dictionary
-            phones = []
-
-        if sum([pnc.syllable_count(p) for p in phones]) != syls or not sent:
+        if syllableCount.countLine(sent) != syls or not sent:
             return None
         else:
             return ''.join(c for c in sent if c not in string.punctuation)
 
-
-def rhyme_degree(target_word, test_word):
-    """Returns a number between 0 and 1 as the degree of rhyming between two
-    words, with 1 being an exact rhyme and 0 being no similarity at all."""
-
-    if test_word in pnc.rhymes(target_word):
-        print('\rFound rhyme pair from the pronouncing library:')
-        print(target_word, 'and', test_word)
-        return 1
-
-    # extract word part from last stressed syllable excluding that syll's onset
-    rhymes = {target_word: None, test_word: None}
-    for word in rhymes:
-        try:
-            # get pronounciation for word
-            pron = pnc.phones_for_word(word)[0]
-        except IndexError:  # in case one of the words is not in the dictionary
-            return 0
-        # get stress pattern and find last stressed syllables
-        stress = pnc.stresses(pron)
-        last_stress = max([stress.rfind('1'), stress.rfind('2')])
-        try:
-            sylls = ARPA.syllabifyARPA(pron, return_list=True)
-        except ValueError:  # in case the word cannot be syllabified
-            return 0
-        sylls = sylls[last_stress:]
-        first_onset = re.split(ARPA.VOWELS_REGEX, sylls[0])[0]
-        sylls[0] = sylls[0].replace(first_onset, '', 1)
-        rhymes[word] = sylls
-
-    # test for matching vowels and consonant clusters in onset and coda
-    # the stressed vowel weighs double
-    phones = 1 + max([sum(len(syll.split()) for syll in rhyme)
-                      for rhyme in rhymes.values()])
-    matches = 0
-    for target_syll, test_syll in zip(rhymes[target_word], rhymes[test_word]):
-        target_vowel = [phone for phone in target_syll.split()
-                        if re.match(ARPA.VOWELS_REGEX, phone)][0]
-        test_vowel = [phone for phone in test_syll.split()
-                      if re.match(ARPA.VOWELS_REGEX, phone)][0]
-        target_clusters = target_syll.split(target_vowel)
-        test_clusters = test_syll.split(test_vowel)
-        # measure match of syllable onsets
-        matches += len(
-            set(target_clusters[0].strip().split()).intersection(
-                set(test_clusters[0].strip().split())
-            )
-        )
-        # measure match of vowels
-        if target_vowel[:2] == test_vowel[:2]:  # test for the vowel itself
-            matches += 1
-            # test for similar stress
-            if (target_vowel[-1] in ['1', '2']
-                    and target_vowel[-1] == test_vowel[-1]):
-                matches += 1
-        # measure match of syllable codas
-        matches += len(
-            set(target_clusters[1].strip().split()).intersection(
-                set(test_clusters[1].strip().split())
-            )
-        )
-    degree = matches / phones
-    if degree > 0.7:
-        print('\rFound rhyme pair with a rhyming degree of: ', degree)
-        print(rhymes)
-    return degree
-
-
-def is_rhyme_pair(target_line, test_line, same_allowed=False, min_degree=0.8):
-    """Return true if the passed lines rhyme."""
-
-    # avoid later problems from empty or None lines
-    if (not target_line or target_line == ''
-            or not test_line or test_line == ''):
-        return False
-
-    # get the last words from the lines
-    target_last = target_line.split()[-1]
-    test_last = test_line.split()[-1]
-
-    if target_last.lower() == test_last.lower() and not same_allowed:
-        return False
-
-    # TODO: take short words into account: combine short words and see if they
-    # can constitute one phonological word, i.e. one stress unit
-    degree = rhyme_degree(target_last, test_last)
-    if degree > min_degree:
-        return True
-    else:
-        return False
-
 #poem = Poem('ABABCDCDEFEGFG76767676767676')
 poem = Poem('ABAB7676')
 poem.print_poem()
@@ -0,0 +1,23 @@
+import hashlib
+import random
+
+# Seeds for reproducible runs.
+#
+# Every unit of work that may run in another process (a subsonnet, a rhyme
+# group, a poem of a batch) gets its own seed derived from the run's base
+# seed and the unit's position, and reseeds the global random module (which
+# markovify samples from) before it starts. The output then depends only on
+# the base seed, not on which process ran what or in which order. Seeds are
+# derived with SHA-256 since hash() of strings changes between processes.
+
+def deriveSeed(seed, *keys):
+    """64 bit seed for the unit named by keys, None if seed is None"""
+    if seed is None:
+        return None
+    digest = hashlib.sha256(repr((seed,) + keys).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+def seedRandom(seed):
+    """Reseed the global random module unless seed is None"""
+    if seed is not None:
+        random.seed(seed)
@@ -0,0 +1,200 @@
+import config
+import marshal
+import mmap
+import os
+import collections
+import random
+import re
+import string
+import struct
+import lineReservoir
+import modelCache
+import rhyme
+import syllableCount
+
+# Store of ready made lines indexed by rhyme tail and syllable count.
+#
+# The rhyme tail of a line is the rhyming part of its last word (see
+# rhyme.rhymingPart), so all lines under one tail rhyme perfectly with each
+# other and finding k lines that rhyme with an anchor and meet their
+# syllable targets is k index lookups. Lines come from syllable walks over
+# the models, which pass the models' overlap test like any generated line.
+# Clauses of the corpus can be added, but they are copied verbatim and skip
+# the markovify_max_overlap novelty test, so they are only stored on request.
+#
+# On disk a store is a length prefixed marshal header, holding the index
+# {(tail, syllables): (offset, length, line count)}, followed by a blob with the lines of
+# each key joined by newlines. The blob is read through mmap, so opening a
+# store only reads the header and forked workers share the pages.
+
+STORE_VERSION = 2
+HEADER_SIZE = struct.Struct('<Q')
+DEFAULT_SYLLABLES = range(4, 10)
+DEFAULT_TRIES = 10
+DEFAULT_GENERATED = 2000
+
+# Clause boundaries in running text
+CLAUSE_SPLIT = re.compile(r'--|[.,;:!?()\[\]"“”—]+|\s[\'‘’]|[\'‘’]\s')
+
+def stripLine(line):
+    return ' '.join(''.join(c for c in line if c not in string.punctuation).split())
+
+def rhymeTail(word):
+    """Rhyming part of a word's first pronunciation as a string, None if the
+    word is not in the dictionary"""
+    pronun = rhyme.pronunciationDict().get(word.lower())
+    if pronun is None:
+        return None
+    return ' '.join(rhyme.rhymingPart(pronun))
+
+def extractLines(text, syllables=DEFAULT_SYLLABLES, counter=None):
+    """(line, syllables) for every corpus clause of two or more words whose
+    syllable count is in syllables"""
+    counter = counter or syllableCount.defaultCounter
+    syllables = set(syllables)
+    for clause in CLAUSE_SPLIT.split(' '.join(text.split())):
+        line = stripLine(clause)
+        if len(line.split()) < 2:
+            continue
+        line = line[0].upper() + line[1:]
+        syls = counter.countLine(line)
+        if syls in syllables:
+            yield line, syls
+
+def writeStore(lines, path):
+    """Write (line, syllables) pairs as a store at path, atomically. Lines
+    without a rhyme tail and duplicates are left out."""
+    groups = {}
+    for line, syls in lines:
+        tail = rhymeTail(line.split()[-1])
+        if tail is not None:
+            groups.setdefault((tail, syls), set()).add(line)
+
+    index = {}
+    blob = bytearray()
+    for key in sorted(groups):
+        data = '\n'.join(sorted(groups[key])).encode('utf-8')
+        index[key] = (len(blob), len(data), len(groups[key]))
+        blob += data
+    header = marshal.dumps({'version': STORE_VERSION, 'index': index})
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER_SIZE.pack(len(header)))
+        f.write(header)
+        f.write(blob)
+    os.replace(tmp, path)
+
+class SentenceStore:
+    """Read-only view of a store file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size, = HEADER_SIZE.unpack_from(self.mm)
+        header = marshal.loads(self.mm[HEADER_SIZE.size:HEADER_SIZE.size + size])
+        if header.get('version') != STORE_VERSION:
+            self.mm.close()
+            raise ValueError('Unsupported sentence store version')
+        self.base = HEADER_SIZE.size + size
+        self.index = header['index']
+        # Tails by syllable count, to pick anchors
+        self.tails = {}
+        for tail, syls in self.index:
+            self.tails.setdefault(syls, []).append(tail)
+
+    def lines(self, tail, syls):
+        entry = self.index.get((tail, syls))
+        if entry is None:
+            return []
+        offset, length, _ = entry
+        start = self.base + offset
+        return self.mm[start:start + length].decode('utf-8').split('\n')
+
+    def rhymingLines(self, word, syls, exclude=()):
+        """Lines of `syls` syllables rhyming with word, not ending on word or
+        on any of the lower case words in exclude"""
+        exclude = set(exclude) | {word.lower()}
+        return [line for line in self.lines(rhymeTail(word), syls)
+                if line.split()[-1].lower() not in exclude]
+
+    def findGroup(self, anchor, targets, exclude=()):
+        """One line per syllable count in targets, all rhyming with the anchor
+        line and ending on distinct words not in exclude (lower case), or None
+        if the store has too few"""
+        used = set(exclude) | {anchor.split()[-1].lower()}
+        found = []
+        for syls in targets:
+            candidates = self.rhymingLines(anchor.split()[-1], int(syls), used)
+            if not candidates:
+                return None
+            line = random.choice(candidates)
+            used.add(line.split()[-1].lower())
+            found.append(line)
+        return found
+
+    def count(self, tail, syls):
+        entry = self.index.get((tail, syls))
+        return entry[2] if entry else 0
+
+    def anchorLine(self, syls, partners, tries=DEFAULT_TRIES, exclude=()):
+        """A line of `syls` syllables for which findGroup can likely fill the
+        syllable counts in partners, or None. The store is read-only, so the
+        last words of lines already in the poem are passed as exclude (lower
+        case); their rhyme tails are not used either."""
+        syls = int(syls)
+        exclude = set(exclude)
+        usedTails = set(rhymeTail(word) for word in exclude)
+        needed = collections.Counter(int(s) for s in partners)
+        needed[syls] += 1
+        tails = [tail for tail in self.tails.get(syls, ()) if tail not in usedTails
+                 and all(self.count(tail, s) >= n for s, n in needed.items())]
+        for tail in random.sample(tails, min(tries, len(tails))):
+            lines = [line for line in self.lines(tail, syls)
+                     if line.split()[-1].lower() not in exclude]
+            if not lines:
+                continue
+            anchor = random.choice(lines)
+            if self.findGroup(anchor, partners, exclude) is not None:
+                return anchor
+        return None
+
+    def close(self):
+        self.mm.close()
+
+def loadStore(paths, models=None, generated=DEFAULT_GENERATED, syllables=DEFAULT_SYLLABLES,
+              corpus_lines=False, **kwargs):
+    """Store for the corpus files in paths, from the cache if it is current.
+    On a miss it is built from `generated` lines walked from models, a
+    (forward, reverse) pair, if given, plus the corpus clauses with
+    corpus_lines. `max_overlap_ratio` and `max_overlap_total` are passed to
+    the models' overlap test."""
+    cache_dir = config.Config().model_cache_dir
+    variant = 'lines%d' % generated + ('-corpus' if corpus_lines else '')
+    prefix = modelCache.cachePrefix(SentenceStore, paths, 0, variant)
+    path = os.path.join(cache_dir, prefix + modelCache.corpusHash(paths)[:16] + '.store')
+
+    if os.path.exists(path):
+        try:
+            return SentenceStore(path)
+        except (OSError, ValueError, EOFError, TypeError, struct.error):
+            pass
+
+    lines = []
+    if corpus_lines:
+        counter = models[0].syllableCounter() if models else None
+        lines += extractLines(modelCache.readCorpus(paths), syllables, counter)
+    if models and generated:
+        walker = lineReservoir.LineReservoir(models[0], models[1], syllables, **kwargs)
+        for i in range(generated):
+            syls = walker.syllables[i % len(walker.syllables)]
+            line = walker.generate(syls)
+            if line is not None:
+                lines.append((line, syls))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in os.listdir(cache_dir):
+        if stale.startswith(prefix):
+            os.remove(os.path.join(cache_dir, stale))
+    writeStore(lines, path)
+    return SentenceStore(path)
@@ -0,0 +1,202 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+import config
+import instrument
+import logSetup
+import new_r_sonet_gen_parallel as crown
+
+# Local HTTP service for poem and crown generation.
+#
+# The event loop only parses requests and waits, all generation runs in a
+# process pool whose workers load the models once at startup. Requests for
+# the same kind and pattern that arrive while one is being generated share
+# its result instead of queueing another job. Every request has a deadline:
+# waiting is shielded, so a request that times out gets a 504 while the job
+# keeps running for the others waiting on it. A job is still bounded: its
+# poems give up after config.job_max_attempts sentence attempts, which
+# fails the job and frees its worker. When too many distinct jobs
+# are in flight new ones are turned away with a 503 rather than queued
+# behind the rest.
+#
+#   GET /poem?pattern=ABAB6767&timeout=5
+#   GET /crown?pattern=ABCB7676
+#   GET /health
+#   GET /stats      counters and timers of the finished jobs, see instrument
+
+MAX_HEADER_LINES = 100
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+def _init_service_worker(fFile):
+    # Generation progress output would otherwise mix with the server's
+    sys.stdout = sys.stderr
+    crown._init_worker(fFile)
+
+# Jobs return their response body and the worker's instrument stats
+
+def _poem_job(pattern):
+    with crown.attempt_limit(config.Config().job_max_attempts):
+        poem = crown._sonnet_task((pattern, None, None, None))
+    return {'poem': poem.poem}, crown._task_stats()
+
+def _crown_job(pattern):
+    with crown.attempt_limit(config.Config().job_max_attempts):
+        sonnet_crown = crown.Sonnet_crown(pattern, None, crown._worker_models['forw'],
+                                          crown._worker_models['rev'])
+        sonnet_crown.generate_full()
+    sonnet_crown.close()
+    return ({'master': sonnet_crown.master.poem,
+             'subsonnets': [poem.poem for poem in sonnet_crown.subsonnets]},
+            crown._task_stats())
+
+JOBS = {'/poem': _poem_job, '/crown': _crown_job}
+
+class PoemService:
+    """Coalescing front end to a process pool of generation workers"""
+
+    def __init__(self, fFile=crown.DEFAULT_FILE, processes=None):
+        self.config = config.Config()
+        # Loaded here first, so forked workers start warm
+        with contextlib.redirect_stdout(sys.stderr):
+            crown._init_worker(fFile)
+        crown.freeze_models()
+        self.executor = ProcessPoolExecutor(processes, initializer=_init_service_worker,
+                                            initargs=(fFile,))
+        # In-flight jobs by (path, pattern)
+        self.jobs = {}
+        self.served = 0
+        self.coalesced = 0
+
+    async def generate(self, path, pattern, timeout):
+        """Result of the job for path and pattern, sharing a running one if
+        there is one. Raises asyncio.TimeoutError after timeout seconds."""
+        key = (path, pattern)
+        job = self.jobs.get(key)
+        if job is None:
+            if len(self.jobs) >= self.config.service_max_pending:
+                raise OverflowError('too many jobs in flight')
+            loop = asyncio.get_running_loop()
+            job = loop.run_in_executor(self.executor, JOBS[path], pattern)
+            self.jobs[key] = job
+            job.add_done_callback(lambda _: self.finished(key, job))
+        else:
+            self.coalesced += 1
+        # The shield keeps a timed out waiter from cancelling the shared job
+        body, _ = await asyncio.wait_for(asyncio.shield(job), timeout)
+        return body
+
+    def finished(self, key, job):
+        self.jobs.pop(key, None)
+        # Once per job, however many requests shared it
+        if not job.cancelled() and job.exception() is None:
+            instrument.merge(job.result()[1])
+
+    async def handle(self, method, target):
+        """(status, body) for a request"""
+        url = urllib.parse.urlsplit(target)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/health':
+            return 200, {'jobs': len(self.jobs), 'served': self.served,
+                         'coalesced': self.coalesced}
+        if url.path == '/stats':
+            return 200, instrument.report()
+        if url.path not in JOBS:
+            return 404, {'error': 'unknown path ' + url.path}
+        if method != 'GET':
+            return 405, {'error': 'only GET is supported'}
+
+        pattern = query.get('pattern', [''])[0]
+        if not crown.valid_pattern(pattern):
+            return 400, {'error': 'invalid pattern'}
+        try:
+            timeout = float(query.get('timeout', [self.config.service_timeout])[0])
+        except ValueError:
+            return 400, {'error': 'invalid timeout'}
+
+        start = time.monotonic()
+        try:
+            result = await self.generate(url.path, pattern, timeout)
+        except asyncio.TimeoutError:
+            return 504, {'error': 'deadline of %gs exceeded' % timeout}
+        except OverflowError as e:
+            return 503, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': repr(e)}
+        self.served += 1
+        # Coalesced requests share the result, each gets its own timing
+        return 200, dict(result, seconds=round(time.monotonic() - start, 3))
+
+    async def serve_client(self, reader, writer):
+        try:
+            request = await reader.readline()
+            parts = request.decode('latin-1').split()
+            # Headers are not used, but have to be read
+            for _ in range(MAX_HEADER_LINES):
+                if (await reader.readline()) in (b'\r\n', b'\n', b''):
+                    break
+            if len(parts) != 3:
+                status, body = 400, {'error': 'malformed request line'}
+            else:
+                status, body = await self.handle(parts[0], parts[1])
+
+            payload = json.dumps(body).encode('utf-8')
+            writer.write(('HTTP/1.1 %d %s\r\n'
+                          'Content-Type: application/json\r\n'
+                          'Content-Length: %d\r\n'
+                          'Connection: close\r\n\r\n'
+                          % (status, REASONS[status], len(payload))).encode('latin-1'))
+            writer.write(payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+async def serve(host=None, port=None, unix=None, fFile=crown.DEFAULT_FILE, processes=None):
+    """Run the service until cancelled, on a Unix socket if unix is given"""
+    cfg = config.Config()
+    service = PoemService(fFile, processes)
+    try:
+        if unix:
+            server = await asyncio.start_unix_server(service.serve_client, unix)
+            where = unix
+        else:
+            host = host or cfg.service_host
+            port = port or cfg.service_port
+            server = await asyncio.start_server(service.serve_client, host, port)
+            where = '%s:%d' % (host, port)
+        print('Serving poems on ' + where, file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+        if unix and os.path.exists(unix):
+            os.remove(unix)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve poems over local HTTP.')
+    parser.add_argument('--host', help='address to listen on')
+    parser.add_argument('--port', type=int, help='port to listen on')
+    parser.add_argument('--unix', help='listen on this Unix socket instead')
+    parser.add_argument('-f', '--file', default=crown.DEFAULT_FILE, help='corpus file')
+    parser.add_argument('-p', '--processes', type=int, help='worker processes, one per core by default')
+    parser.add_argument('--log-level', help='DEBUG, INFO, WARNING, ... (config.log_level by default)')
+    args = parser.parse_args(argv)
+    logSetup.configureLogging(args.log_level)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, args.file, args.processes))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
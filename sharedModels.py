@@ -0,0 +1,150 @@
+import config
+import marshal
+import mmap
+import os
+import struct
+import compactChain
+import generateRhymes as gr
+import markoviRhyme
+import modelCache
+import syllableCount
+
+# Models published to a memory mapped file, for generation workers.
+#
+# Forked workers start out sharing their parent's models, but the chains are
+# millions of small Python objects and every lookup writes reference counts,
+# so page by page each worker ends up with a private copy. A published model
+# file holds what generation reads, the compact chains (see compactChain) and
+# the rejoined corpus texts of the overlap test, as flat buffers. Every
+# process maps the file read-only and builds its models on views of the
+# mapping, so however many workers attach, the page cache holds one copy.
+# The small per-process tables, the reverse model's rhyme start states and
+# the vocabulary's syllable counts, are stored as well, so attaching needs
+# no pronunciation dictionary. Parsed sentences are not published,
+# generation does not need them.
+#
+# The file is a length prefixed marshal header, with the model settings, the
+# small tables and the (offset, length) of every section, followed by the
+# sections, each starting on an 8 byte boundary.
+
+FILE_VERSION = 2
+HEADER_SIZE = struct.Struct('<Q')
+ALIGN = 8
+
+class MappedText:
+    """Substring tests on UTF-8 text in a buffer, standing in for the
+    rejoined_text string of a markovify model"""
+
+    def __init__(self, mm, offset, length):
+        self.mm = mm
+        self.start = offset
+        self.end = offset + length
+
+    def __contains__(self, text):
+        # UTF-8 is self synchronising, a byte match is a character match
+        return self.mm.find(text.encode('utf-8'), self.start, self.end) != -1
+
+    def __len__(self):
+        return self.end - self.start
+
+def _modelSettings(model):
+    settings = {'state_size': model.state_size}
+    if isinstance(model, markoviRhyme.rhymeText):
+        settings.update(line_reversed=model.line_reversed, rhyme_order=model.rhyme_order)
+    return settings
+
+def publishModels(forw_model, rev_model, path):
+    """Write the models to a model file at path, atomically. Models with a
+    plain markovify chain are converted to compact chains on the way."""
+    sections = {}
+    blobs = []
+    size = 0
+    for name, model in (('forward', forw_model), ('reverse', rev_model)):
+        chain = model.chain
+        if not isinstance(chain, compactChain.CompactChain):
+            chain = compactChain.CompactChain(None, model.state_size, model=chain.model)
+        for part, blob in (('chain', chain.to_bytes()),
+                           ('text', model.rejoined_text.encode('utf-8'))):
+            sections[name + '_' + part] = (size, len(blob))
+            padding = -len(blob) % ALIGN
+            blobs.append(blob + b'\0' * padding)
+            size += len(blob) + padding
+
+    header = marshal.dumps({'version': FILE_VERSION, 'sections': sections,
+                            'forward': _modelSettings(forw_model),
+                            'reverse': _modelSettings(rev_model),
+                            'rhyme_table': rev_model.rhymeTable,
+                            'syllables': forw_model.syllableCounter().table()})
+    header += b'\0' * (-(HEADER_SIZE.size + len(header)) % ALIGN)
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER_SIZE.pack(len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp, path)
+
+class SharedModels:
+    """Forward and reverse models attached to a model file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size, = HEADER_SIZE.unpack_from(self.mm)
+        header = marshal.loads(self.mm[HEADER_SIZE.size:HEADER_SIZE.size + size])
+        if header.get('version') != FILE_VERSION:
+            self.mm.close()
+            raise ValueError('Unsupported model file version')
+        base = HEADER_SIZE.size + size
+        self.sections = {name: (base + offset, length)
+                         for name, (offset, length) in header['sections'].items()}
+
+        settings = header['forward']
+        self.forward = markoviRhyme.forwardText(
+            None, state_size=settings['state_size'], chain=self._chain('forward'))
+        self.forward.rejoined_text = self._text('forward')
+
+        settings = header['reverse']
+        self.reverse = markoviRhyme.rhymeText(
+            None, state_size=settings['state_size'], chain=self._chain('reverse'),
+            rhyme_order=settings['rhyme_order'], rhyme_table=header['rhyme_table'])
+        self.reverse.line_reversed = settings['line_reversed']
+        self.reverse.rejoined_text = self._text('reverse')
+
+        syllables = syllableCount.SyllableCounter.fromCounts(*header['syllables'])
+        self.forward.syllables = self.reverse.syllables = syllables
+
+    def _chain(self, name):
+        offset, length = self.sections[name + '_chain']
+        return compactChain.CompactChain.from_buffer(memoryview(self.mm)[offset:offset + length])
+
+    def _text(self, name):
+        offset, length = self.sections[name + '_text']
+        return MappedText(self.mm, offset, length)
+
+    def models(self):
+        return self.forward, self.reverse
+
+def loadShared(fFile):
+    """SharedModels for fFile, a corpus file or directory, publishing the
+    models built by generateRhymes.buildModels first unless the model file
+    is current"""
+    cache_dir = config.Config().model_cache_dir
+    paths = gr.corpusFiles(fFile)
+    prefix = modelCache.cachePrefix(SharedModels, paths, 0, 'published')
+    path = os.path.join(cache_dir, prefix + modelCache.corpusHash(paths)[:16] + '.models')
+
+    if os.path.exists(path):
+        try:
+            return SharedModels(path)
+        except (OSError, ValueError, EOFError, TypeError, KeyError, struct.error):
+            pass
+
+    forw_model, rev_model = gr.buildModels(fFile, compact=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in os.listdir(cache_dir):
+        if stale.startswith(prefix):
+            os.remove(os.path.join(cache_dir, stale))
+    publishModels(forw_model, rev_model, path)
+    return SharedModels(path)
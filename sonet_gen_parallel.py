@@ -3,11 +3,12 @@ import os
 import markovify
 import config
 import string
-import syllabifyARPA as ARPA
-import re
+from rhymeDegree import is_rhyme_pair
 from multiprocessing import Pool
 import sys # For debugging exit
 import random
+import modelCache
+import syllableCount
 
 #TODO: Implement new rhyming method
 #TODO: Allow lines with more than 9 syllables
@@ -24,14 +25,11 @@ class Sonnet_crown:
         self.config = config.Config()
         is_test = self.config.is_test
 
-        all_text = ''
-        for file in os.listdir(self.config.markovify_input_dir):
-            if os.path.isdir(file):  # skip folders
-                continue
-            with open(self.config.markovify_input_dir + file,
-                      encoding='utf-8') as f:
-                all_text += f.read()
-        self.text_model = markovify.Text(all_text)
+        paths = [self.config.markovify_input_dir + file
+                 for file in os.listdir(self.config.markovify_input_dir)]
+        # skip folders
+        paths = [path for path in paths if not os.path.isdir(path)]
+        self.text_model = modelCache.loadModel(markovify.Text, paths)
 
         self.pattern = base_pattern
         # Count number of lines in sonnet
@@ -94,14 +92,11 @@ class Poem:
 
         if model is None:
             # Generate text model
-            all_text = ''
-            for file in os.listdir(self.config.markovify_input_dir):
-                if os.path.isdir(file):  # skip folders
-                    continue
-                with open(self.config.markovify_input_dir + file,
-                          encoding='utf-8') as f:
-                    all_text += f.read()
-            self.text_model = markovify.Text(all_text)
+            paths = [self.config.markovify_input_dir + file
+                     for file in os.listdir(self.config.markovify_input_dir)]
+            # skip folders
+            paths = [path for path in paths if not os.path.isdir(path)]
+            self.text_model = modelCache.loadModel(markovify.Text, paths)
         else:
             self.text_model = model
 
@@ -391,108 +386,11 @@ class Poem:
         if sent == None:
             return None
 
-        # Might be double work checking for punctuation
-        sentNoPunctuation = sent[0:-1]
-        try:
-            phones = [pnc.phones_for_word(p)[0] for p in sentNoPunctuation.split()]
-        except IndexError:
-            # Word not found in dictionary
-            phones = []
-
-        if sum([pnc.syllable_count(p) for p in phones]) != syls or not sent:
+        if syllableCount.countLine(sent) != syls or not sent:
             return None
         else:
             return ''.join(c for c in sent if c not in string.punctuation)
 
-def rhyme_degree(target_word, test_word):
-    """Returns a number between 0 and 1 as the degree of rhyming between two
-    words, with 1 being an exact rhyme and 0 being no similarity at all."""
-
-    if test_word in pnc.rhymes(target_word):
-        print('\rFound rhyme pair from the pronouncing library:')
-        print(target_word, 'and', test_word)
-        return 1
-
-    # extract word part from last stressed syllable excluding that syll's onset
-    rhymes = {target_word: None, test_word: None}
-    for word in rhymes:
-        try:
-            # get pronounciation for word
-            pron = pnc.phones_for_word(word)[0]
-        except IndexError:  # in case one of the words is not in the dictionary
-            return 0
-        # get stress pattern and find last stressed syllables
-        stress = pnc.stresses(pron)
-        last_stress = max([stress.rfind('1'), stress.rfind('2')])
-        try:
-            sylls = ARPA.syllabifyARPA(pron, return_list=True)
-        except ValueError:  # in case the word cannot be syllabified
-            return 0
-        sylls = sylls[last_stress:]
-        first_onset = re.split(ARPA.VOWELS_REGEX, sylls[0])[0]
-        sylls[0] = sylls[0].replace(first_onset, '', 1)
-        rhymes[word] = sylls
-
-    # test for matching vowels and consonant clusters in onset and coda
-    # the stressed vowel weighs double
-    phones = 1 + max([sum(len(syll.split()) for syll in rhyme)
-                      for rhyme in rhymes.values()])
-    matches = 0
-    for target_syll, test_syll in zip(rhymes[target_word], rhymes[test_word]):
-        target_vowel = [phone for phone in target_syll.split()
-                        if re.match(ARPA.VOWELS_REGEX, phone)][0]
-        test_vowel = [phone for phone in test_syll.split()
-                      if re.match(ARPA.VOWELS_REGEX, phone)][0]
-        target_clusters = target_syll.split(target_vowel)
-        test_clusters = test_syll.split(test_vowel)
-        # measure match of syllable onsets
-        matches += len(
-            set(target_clusters[0].strip().split()).intersection(
-                set(test_clusters[0].strip().split())
-            )
-        )
-        # measure match of vowels
-        if target_vowel[:2] == test_vowel[:2]:  # test for the vowel itself
-            matches += 1
-            # test for similar stress
-            if (target_vowel[-1] in ['1', '2']
-                    and target_vowel[-1] == test_vowel[-1]):
-                matches += 1
-        # measure match of syllable codas
-        matches += len(
-            set(target_clusters[1].strip().split()).intersection(
-                set(test_clusters[1].strip().split())
-            )
-        )
-    degree = matches / phones
-    if degree > 0.7:
-        print('\rFound rhyme pair with a rhyming degree of: ', degree)
-        print(rhymes)
-    return degree
-
-def is_rhyme_pair(target_line, test_line, same_allowed=False, min_degree=0.8):
-    """Return true if the passed lines rhyme."""
-
-    # avoid later problems from empty or None lines
-    if (not target_line or target_line == ''
-            or not test_line or test_line == ''):
-        return False
-
-    # get the last words from the lines
-    target_last = target_line.split()[-1]
-    test_last = test_line.split()[-1]
-
-    if target_last.lower() == test_last.lower() and not same_allowed:
-        return False
-
-    # TODO: take short words into account: combine short words and see if they
-    # can constitute one phonological word, i.e. one stress unit
-    degree = rhyme_degree(target_last, test_last)
-    if degree > min_degree:
-        return True
-    else:
-        return False
-
 #poem = Poem('ABABCDCDEFEGFG76767676767676')
 #poem.print_poem()
 sonnet_crown = Sonnet_crown('ABCB7676')
@@ -1,14 +1,13 @@
 import markovify
 import config
+import modelCache
 import os
 
 config = config.Config()
 
-all_text = ''
-for file in os.listdir(config.markovify_input_dir):
-    with open(config.markovify_input_dir + file) as f:
-        all_text += f.read()
-text_model = markovify.Text(all_text)
+paths = [config.markovify_input_dir + file
+         for file in os.listdir(config.markovify_input_dir)]
+text_model = modelCache.loadModel(markovify.Text, paths)
 
 line = text_model.make_short_sentence(
     config.poem_first_syl_count * config.poem_avg_char_per_syl,
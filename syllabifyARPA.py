@@ -7,7 +7,7 @@
 # Vasundhara Gautam
 # October 3rd, 2017
 
-import pandas as pd
+import functools
 import re
 import sys
 
@@ -36,6 +36,22 @@ PHONESET = set(['AA', 'AE', 'AH', 'AO', 'AW', 'AY', 'B',
 
 # Optional stress markers (0,1,2) after the vowel for flexibility
 VOWELS_REGEX = re.compile(r'(?:AA|AE|AH|AO|AW|AY|EH|ER|EY|IH|IY|OW|OY|UW|UH)[012]?')
+BASE_VOWELS = ['AA', 'AE', 'AH', 'AO', 'AW', 'AY', 'EH', 'ER', 'EY', 'IH', 'IY',
+               'OW', 'OY', 'UW', 'UH']
+VOWELS = set(vowel + stress for vowel in BASE_VOWELS for stress in ['', '0', '1', '2'])
+
+# Cluster sets used by the onset and coda tests
+VOICELESS_STOPS = VOICELESS.intersection(STOPS)
+VOICELESS_FRICATIVES = VOICELESS.intersection(FRICATIVES)
+ONSET_FRICATIVES = VOICELESS_FRICATIVES.union(['V'])
+S_ONSET_CONSONANTS = VOICELESS.difference(AFFRICATES)
+S_ONSET_NASALS = NASALS.difference(['NG'])
+
+SYLLABIFY_CACHE_SIZE = 1 << 16
+
+def isVowel(phone):
+    """True if phone is an ARPABET vowel with optional stress marker"""
+    return phone in VOWELS
 
 def syllabifyARPA(arpa_arr, return_list=False, silence_warnings=False):
     """
@@ -60,66 +76,76 @@ def syllabifyARPA(arpa_arr, return_list=False, silence_warnings=False):
         cannot be syllabified according to English syllabification rules.
     """
 
-    def handleError(string):
+    try:
+        syllables = list(syllabify(arpa_arr))
+    except ValueError:
         if not silence_warnings:
-            raise ValueError(string)
+            raise
+        syllables = []
 
-    ret = pd.Series(None)
     if return_list:
-        ret = []
+        return syllables
 
-    try:
-        arpa_arr = arpa_arr.split() # Allows for phoneme array and string input
-    except:
-        pass
+    # pandas is only needed for this form, keep it out of the hot path
+    import pandas as pd
+    return pd.Series(syllables, dtype=object)
+
+def syllabify(arpa_arr):
+    """
+    Fast form of syllabifyARPA, cached per pronunciation.
+
+    Args:
+        arpa_arr: A string or array of ARPABET phones with optional stress markers
+        on the vowels.
 
-    for i in range(len(arpa_arr)):
-        arpa_arr[i] = arpa_arr[i].upper()
+    Returns:
+        Tuple of syllable strings.
+
+    Raises:
+        ValueError as syllabifyARPA.
+    """
+    if isinstance(arpa_arr, str):
+        arpa_arr = arpa_arr.split() # Allows for phoneme array and string input
+    return _syllabify(tuple(phone.upper() for phone in arpa_arr))
 
+@functools.lru_cache(maxsize=SYLLABIFY_CACHE_SIZE)
+def _syllabify(arpa_arr):
     word = ' '.join(arpa_arr)
 
     if not (testInPhoneset(arpa_arr)):
-        handleError('Input %s contains non-ARPABET phonemes' % word)
-        return ret
+        raise ValueError('Input %s contains non-ARPABET phonemes' % word)
 
     final_arr = []
     temp_arr = []
 
     # Append till and including vowels
-    for i in range(len(arpa_arr)):
-        temp_arr.append(arpa_arr[i])
-        if re.match(VOWELS_REGEX, arpa_arr[i]):
+    for phone in arpa_arr:
+        temp_arr.append(phone)
+        if phone in VOWELS:
             final_arr.append(temp_arr)
             temp_arr = []
 
     # Handle potential remaining coda consonants
-    for i in range(len(temp_arr)):
+    if temp_arr:
         if len(final_arr) < 1:
-            handleError('Input error - no vowel in %s' % word)
-            return ret
-        final_arr[-1].append(temp_arr[i])
+            raise ValueError('Input error - no vowel in %s' % word)
+        final_arr[-1].extend(temp_arr)
 
     # All onsets are maximized, some are illegal - fixing that
     for i in range(len(final_arr)):
         while testLegalOnset(final_arr[i]):
             if i == 0:
-                handleError('Bad onset cluster in %s' % word)
-                return ret
+                raise ValueError('Bad onset cluster in %s' % word)
             c = testLegalOnset(final_arr[i])
             final_arr[i].remove(c)
             final_arr[i-1].append(c)
 
-    for i in range(len(final_arr)):
-        if not testLegalCoda(final_arr[i]):
-            handleError('Impossible to syllabify %s according to English '
-                          'syllabification rules.' % word)
-            return ret
-
-    ret = pd.Series([' '.join(syllable) for syllable in final_arr])
-    if return_list:
-        ret = list(ret)
+    for syllable in final_arr:
+        if not testLegalCoda(syllable):
+            raise ValueError('Impossible to syllabify %s according to English '
+                             'syllabification rules.' % word)
 
-    return ret
+    return tuple(' '.join(syllable) for syllable in final_arr)
 
 def testInPhoneset(arr):
     """
@@ -133,8 +159,8 @@ def testInPhoneset(arr):
         True if input array consists of 2-letter ARPABET phones with optional
         stress markers.
     """
-    for i in range(len(arr)):
-        if not (arr[i] in PHONESET or re.match(VOWELS_REGEX, arr[i])):
+    for phone in arr:
+        if not (phone in PHONESET or phone in VOWELS):
             return False
     return True
 
@@ -153,11 +179,11 @@ def testLegalOnset(syllable):
 
     cluster = []
 
-    for i in range(len(syllable)):
-        if re.match(VOWELS_REGEX, syllable[i]):
+    for phone in syllable:
+        if phone in VOWELS:
             break
         else:
-            cluster.append(syllable[i])
+            cluster.append(phone)
 
     length = len(cluster)
 
@@ -171,9 +197,9 @@ def testLegalOnset(syllable):
         # Clusters beginning with s can only be of the forms
         # s-voiceless_stop-approximant or s-voiceless_fricative-r
         elif not (
-        (cluster[1] in VOICELESS.intersection(STOPS) and cluster[2] in APPROXIMANTS)
+        (cluster[1] in VOICELESS_STOPS and cluster[2] in APPROXIMANTS)
             or
-        (cluster[1] in VOICELESS.intersection(FRICATIVES) and cluster[2] == 'R')):
+        (cluster[1] in VOICELESS_FRICATIVES and cluster[2] == 'R')):
             return cluster[0]
 
     elif length == 2:
@@ -184,14 +210,14 @@ def testLegalOnset(syllable):
             or
         (cluster[0] in STOPS and cluster[1] in APPROXIMANTS)
             or
-        (cluster[0] in VOICELESS.intersection(FRICATIVES).union(['V']) and
+        (cluster[0] in ONSET_FRICATIVES and
         cluster[1] in APPROXIMANTS)
             or
         # Only s-voiceless_stop, s-voiceless_fricative and s-non_NG_nasals
         # are valid length-2 s-clusters
-        (cluster[0] == 'S' and cluster[1] in VOICELESS.difference(AFFRICATES))
+        (cluster[0] == 'S' and cluster[1] in S_ONSET_CONSONANTS)
             or
-        (cluster[0] == 'S' and cluster[1] in NASALS.difference(['NG']))
+        (cluster[0] == 'S' and cluster[1] in S_ONSET_NASALS)
             or
         # Other clusters normalized through loanwords, e.g. SH-N, S-V, NW, MR
         (cluster[0] == 'SH' and cluster[1] in NASALS and cluster != 'NG')
@@ -224,10 +250,10 @@ def testLegalCoda(syllable):
     cluster = []
 
     postvowel = False
-    for i in range(len(syllable)):
+    for phone in syllable:
         if postvowel:
-            cluster.append(syllable[i])
-        if re.match(VOWELS_REGEX, syllable[i]):
+            cluster.append(phone)
+        if phone in VOWELS:
             postvowel = True
 
     length = len(cluster)
@@ -0,0 +1,101 @@
+import array
+import string
+import threading
+from markovify.chain import END
+
+# Syllable counts for a model's vocabulary, precomputed when the model loads.
+#
+# Words are interned to integer ids and their counts kept in a flat array, so
+# a candidate line is scored by summing integers. Counts use the first CMUdict
+# pronunciation of the word with surrounding punctuation stripped and case
+# folded. Words that are not in the dictionary count as MISSING, and a line
+# containing one has no syllable count (None), so it is always rejected.
+
+MISSING = -1
+
+def normalise(word):
+    return word.strip(string.punctuation).lower()
+
+def wordSyllables(word):
+    """Syllables in a single word, MISSING if it is not in the dictionary"""
+    # Imported on first use, loading pronouncing reads its copy of CMUdict
+    import pronouncing as pnc
+    phones = pnc.phones_for_word(normalise(word))
+    if not phones:
+        return MISSING
+    return pnc.syllable_count(phones[0])
+
+def loadDictionary():
+    """Load pronouncing's CMUdict now rather than on first use, e.g. before
+    forking workers that should share it"""
+    import pronouncing as pnc
+    pnc.init_cmu()
+
+def chainVocabulary(chain):
+    """All words a markovify chain can emit"""
+    if hasattr(chain, 'vocabulary'):
+        # CompactChain has its words interned already
+        return chain.vocabulary()
+    vocabulary = set()
+    for follow in chain.model.values():
+        # Compiled chains store [words, cumulative weights]
+        vocabulary.update(follow[0] if isinstance(follow, list) else follow)
+    vocabulary.discard(END)
+    return vocabulary
+
+class SyllableCounter:
+    """Per-word syllable cache indexed by word id. Words outside the initial
+    vocabulary are counted and added on first use, under a lock, since a line
+    reservoir's filler thread shares the counter with generation."""
+
+    def __init__(self, vocabulary=()):
+        self.ids = {}
+        self.counts = array.array('b')
+        self.lock = threading.Lock()
+        for word in vocabulary:
+            self.wordId(word)
+
+    @classmethod
+    def fromCounts(cls, words, counts):
+        """Counter for words with precomputed counts, as saved by table()"""
+        counter = cls()
+        counter.ids = {word: i for i, word in enumerate(words)}
+        counter.counts = array.array('b', counts)
+        return counter
+
+    def table(self):
+        """(words in id order, counts as bytes), for fromCounts"""
+        return sorted(self.ids, key=self.ids.get), self.counts.tobytes()
+
+    def wordId(self, word):
+        i = self.ids.get(word)
+        if i is None:
+            count = wordSyllables(word)
+            with self.lock:
+                i = self.ids.get(word)
+                if i is None:
+                    # The count is stored before its id is published
+                    i = len(self.counts)
+                    self.counts.append(count)
+                    self.ids[word] = i
+        return i
+
+    def lineIds(self, words):
+        return [self.wordId(word) for word in words]
+
+    def total(self, ids):
+        """Syllables in a line given as word ids, None if any word is missing"""
+        counts = [self.counts[i] for i in ids]
+        if MISSING in counts:
+            return None
+        return sum(counts)
+
+    def countLine(self, line):
+        """Syllables in a line of text, None if any word is missing"""
+        return self.total(self.lineIds(line.split()))
+
+# Shared counter for models built without a vocabulary
+defaultCounter = SyllableCounter()
+
+def countLine(line):
+    return defaultCounter.countLine(line)
@@ -0,0 +1,106 @@
+import random
+import syllableCount
+from markovify.chain import BEGIN, END
+
+# Markov walk that tracks syllables as it goes.
+#
+# Instead of generating whole sentences and rejecting those with the wrong
+# syllable count, the walk does a depth first search over the chain, trying
+# successors in weighted random order and pruning every branch that already
+# has more syllables than the target. A sentence is only accepted when the
+# chain can end exactly on the target, and the search gives up after
+# max_steps successors, so each attempt is bounded.
+
+DEFAULT_TRIES = 10
+DEFAULT_MAX_STEPS = 2000
+DEFAULT_MAX_OVERLAP_RATIO = 0.7
+DEFAULT_MAX_OVERLAP_TOTAL = 15
+
+def weightedOrder(follow, rng=random):
+    """Successors of a state in weighted random order, without replacement,
+    drawn from rng, the random module by default"""
+    if isinstance(follow, list):
+        # Compiled chains store [words, cumulative weights]
+        words, cumWeights = follow
+        weights = [b - a for a, b in zip([0] + cumWeights[:-1], cumWeights)]
+    else:
+        words, weights = list(follow.keys()), list(follow.values())
+    keys = [rng.random() ** (1.0 / w) for w in weights]
+    return [word for _, word in sorted(zip(keys, words), reverse=True)]
+
+class SyllableWalk:
+    """Mixin for markovify.Text models generating sentences with an exact
+    number of syllables. Uses the model's `syllables` counter if one was
+    attached by generateRhymes.buildModels."""
+
+    def syllableCounter(self):
+        return getattr(self, 'syllables', None) or syllableCount.defaultCounter
+
+    def walk_syllables(self, syls, init_state=None, max_steps=DEFAULT_MAX_STEPS,
+                       drop_last=False, accept=None, rng=random):
+        """Return a list of words with exactly `syls` syllables, or None if
+        the search runs out of steps. With drop_last the last word is not
+        counted. `accept` can reject otherwise complete word lists. The walk
+        draws from rng, the random module by default."""
+        counter = self.syllableCounter()
+        model = self.chain.model
+        state = init_state or (BEGIN,) * self.chain.state_size
+
+        words = [word for word in state if word != BEGIN]
+        counts = [counter.counts[i] for i in counter.lineIds(words)]
+        follow = model.get(state)
+        if syllableCount.MISSING in counts or follow is None:
+            return None
+        total = sum(counts)
+        last = counts[-1] if counts else 0
+
+        stack = [(state, words, total, last, iter(weightedOrder(follow, rng)))]
+        steps = 0
+        while stack and steps < max_steps:
+            state, words, total, last, successors = stack[-1]
+            word = next(successors, None)
+            if word is None:
+                stack.pop()
+                continue
+            steps += 1
+
+            if word == END:
+                kept = total - last if drop_last else total
+                if words and kept == syls and (accept is None or accept(words)):
+                    return words
+                continue
+
+            count = counter.counts[counter.wordId(word)]
+            if count == syllableCount.MISSING:
+                continue
+            # Everything but the new word is kept, no way back under the target
+            if (total if drop_last else total + count) > syls:
+                continue
+            next_state = state[1:] + (word,)
+            # One lookup, chains like CompactChain build the entry on access
+            follow = model.get(next_state)
+            if follow is None:
+                continue
+            stack.append((next_state, words + [word], total + count, count,
+                          iter(weightedOrder(follow, rng))))
+        return None
+
+    def make_syllable_sentence(self, syls, init_state=None, **kwargs):
+        """Like make_sentence, but for sentences of exactly `syls` syllables.
+        Passes `max_steps`, `drop_last` and `rng` on to walk_syllables."""
+        tries = kwargs.get('tries', DEFAULT_TRIES)
+        mor = kwargs.get('max_overlap_ratio', DEFAULT_MAX_OVERLAP_RATIO)
+        mot = kwargs.get('max_overlap_total', DEFAULT_MAX_OVERLAP_TOTAL)
+        max_steps = kwargs.get('max_steps', DEFAULT_MAX_STEPS)
+        drop_last = kwargs.get('drop_last', False)
+        rng = kwargs.get('rng', random)
+
+        accept = None
+        if kwargs.get('test_output', True) and hasattr(self, 'rejoined_text'):
+            accept = lambda words: self.test_sentence_output(words, mor, mot)
+
+        for _ in range(tries):
+            words = self.walk_syllables(syls, init_state, max_steps, drop_last, accept, rng)
+            if words is not None:
+                return self.word_join(words)
+        return None